@@ -1,7 +1,7 @@
 import json
 import os
 import shutil
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from pydantic import BaseModel, Field
 from datetime import datetime
 
@@ -10,6 +10,7 @@ from datetime import datetime
 class GeneralConfig(BaseModel):
     log_retention_days: int = 7
     gateway_api_key: str = ""
+    count_tokens_locally: bool = False # Recount tokens with tiktoken when upstream omits usage
 
 class ModelEntry(BaseModel):
     model: str
@@ -58,6 +59,9 @@ class RetrySettings(BaseModel):
     rounds: Dict[str, int] = {"t1": 1, "t2": 1, "t3": 1}
     max_retries: Dict[str, int] = {"t1": 3, "t2": 3, "t3": 3}
     conditions: RetryConfig = RetryConfig()
+    # Failure scoring overrides: status code / error keyword -> (penalty, cooldown_seconds)
+    status_policy: Dict[int, Tuple[float, int]] = {429: (10.0, 60), 401: (50.0, 300), 403: (50.0, 300)}
+    keyword_policy: Dict[str, Tuple[float, int]] = {}
 
 class RouterModelConfig(BaseModel):
     enabled: bool = False
@@ -194,6 +198,12 @@ class ConfigManager:
     _base_dir = os.path.dirname(os.path.abspath(__file__))
     _config_path: str = os.path.join(_base_dir, "config.json")
     _backup_path: str = os.path.join(_base_dir, "config.backup.json")
+    # Pre-merged request parameter defaults, rebuilt whenever _config is replaced
+    global_defaults: Dict[str, Any] = {} # params.global_params
+    merged_defaults: Dict[str, Dict[str, Any]] = {} # { "model_id": {**global_params, **model_params[model_id]} }
+    status_policy: Dict[int, Tuple[float, int]] = {} # retries.status_policy as (penalty, cooldown_seconds)
+    keyword_policy: Dict[str, Tuple[float, int]] = {} # retries.keyword_policy, keys lower-cased like keyword matching
+    version: int = 0 # Bumped on every load/update
 
     def __new__(cls):
         if cls._instance is None:
@@ -261,6 +271,20 @@ class ConfigManager:
         else:
             self._config = AppConfig()
             self.save_config()
+        self._rebuild_param_defaults()
+
+    def _rebuild_param_defaults(self):
+        """Materialize global + per-model param merges so requests copy a single dict."""
+        params = self._config.params
+        self.global_defaults = dict(params.global_params)
+        self.merged_defaults = {
+            model_id: {**params.global_params, **model_params}
+            for model_id, model_params in params.model_params.items()
+        }
+        retries = self._config.retries
+        self.status_policy = dict(retries.status_policy)
+        self.keyword_policy = {k.lower(): policy for k, policy in retries.keyword_policy.items()}
+        self.version += 1
 
     def _migrate_config(self, old_data: dict):
         """Migrate flat config to nested structure."""
@@ -338,6 +362,7 @@ class ConfigManager:
         print(f"[INFO] Config Update Received. Router URL: {new_config.get('router', {}).get('base_url')}")
         self._config = AppConfig(**new_config)
         self.save_config()
+        self._rebuild_param_defaults()
         print(f"[INFO] Config Saved. Current Memory URL: {self._config.router.base_url}")
 
 config_manager = ConfigManager()
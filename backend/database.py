@@ -40,7 +40,7 @@ class RequestLog(Base):
     retry_count = Column(Integer, default=0)
     prompt_tokens = Column(Integer, default=0)
     completion_tokens = Column(Integer, default=0)
-    token_source = Column(String, default="upstream") # upstream / local
+    token_source = Column(String, default="upstream") # upstream / local / missing
     category = Column(String, default="unknown", index=True) # tool, chat, unknown
 
 class ConfigHistory(Base):
@@ -1,4 +1,5 @@
 
+import asyncio
 import logging
 import sys
 import json
@@ -34,6 +35,8 @@ class TraceLogger:
     def __init__(self):
         self.buffer = deque(maxlen=10000) # Ring buffer 10k lines
         self.active_websockets: List[WebSocket] = []
+        self._pending_broadcast: List[str] = [] # Messages waiting for the next coalesced flush
+        self._flush_scheduled = False
         
         # Configure stdout logger
         self.logger = logging.getLogger("smart_route_trace")
@@ -103,26 +106,30 @@ class TraceLogger:
             self.active_websockets.remove(websocket)
 
     def broadcast(self, message: str):
-        # Fire and forget (sync wrapper for async broadcast is tricky in non-async log calls)
-        # However, FastAPI runs in async loop. We can use asyncio.create_task if we have loop access.
-        # But logging might happen in sync context? 
-        # Actually our router is async, so we can await or create task.
-        # For simplicity, we'll store msg and let a background task flush, or iterate directly if active_websockets is thread-safe enough (it's not).
-        # Better: Since our core logic is async, let's make a async broadcast or use a queue.
-        # But to keep it simple and given performance reqs (<200ms), direct send is risky if clients slow.
-        # We will use a naive loop here, assuming standard usage.
-        import asyncio
-        # Check if there's a running loop
+        # Coalesce: queue the message and flush everything queued in this loop tick
+        # with one send task per websocket, instead of one task per message per socket.
+        if not self.active_websockets:
+            return
         try:
             loop = asyncio.get_running_loop()
-            for ws in self.active_websockets:
-                loop.create_task(self._safe_send(ws, message))
         except RuntimeError:
-            pass # No loop
+            return # No loop
+        self._pending_broadcast.append(message)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush_broadcast, loop)
 
-    async def _safe_send(self, ws: WebSocket, msg: str):
+    def _flush_broadcast(self, loop: asyncio.AbstractEventLoop):
+        self._flush_scheduled = False
+        messages = self._pending_broadcast
+        self._pending_broadcast = []
+        for ws in list(self.active_websockets):
+            loop.create_task(self._safe_send(ws, messages))
+
+    async def _safe_send(self, ws: WebSocket, messages: List[str]):
         try:
-            await ws.send_text(msg)
+            for msg in messages:
+                await ws.send_text(msg)
         except:
             self.disconnect(ws)
 
@@ -141,8 +141,8 @@ async def websocket_endpoint(websocket: WebSocket):
 
 # --- OpenAI Protocol ---
 @app.post("/v1/chat/completions", dependencies=[Depends(verify_gateway_key)])
-async def chat_completions(request: ChatCompletionRequest, background_tasks: BackgroundTasks):
-    return await router_engine.route_request(request, background_tasks)
+async def chat_completions(request: ChatCompletionRequest):
+    return await router_engine.route_request(request)
 
 @app.get("/v1/models", dependencies=[Depends(verify_gateway_key)])
 async def list_models():
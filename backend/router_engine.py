@@ -2,20 +2,44 @@ import httpx
 import json
 import time
 import asyncio
+import collections
+import functools
 import logging
 import random
 import uuid
 import traceback
 import os
 import re
+import sys
+import numpy as np
 try:
     import tiktoken
 except ImportError:
     tiktoken = None
+try:
+    import h2 # noqa: F401 - presence enables HTTP/2 in httpx
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+try:
+    import orjson
+    from orjson import loads as _json_loads
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+except ImportError:
+    orjson = None
+    from json import loads as _json_loads
 
+    def _json_dumps(obj) -> str:
+        # Match orjson: UTF-8 text, non-ASCII left unescaped
+        return json.dumps(obj, ensure_ascii=False)
+
+from datetime import datetime
 from typing import List, Dict, Any, Optional, Union
-from fastapi import HTTPException, BackgroundTasks
+from fastapi import HTTPException
 from pydantic import BaseModel
+from sqlalchemy import insert
 
 from config_manager import config_manager, ModelEntry
 from database import AsyncSessionLocal, RequestLog
@@ -39,6 +63,206 @@ class PrintLogger:
 
 logger = PrintLogger()
 
+# Placeholder emitted for image parts when flattening multimodal content to text
+_IMG_PLACEHOLDER = "[图片]"
+
+# Default connect (TTFT) timeouts per level when not set in config
+DEFAULT_CONNECT = {"t1": 5000, "t2": 15000, "t3": 30000}
+
+# Upstream failure classification: one scan of the error message, then table lookups
+_ERROR_PATTERN = re.compile(
+    r"(?P<ttft>TTFT Timeout)|(?P<total>Total Timeout)|(?P<status>Status Code Error)"
+    r"|(?P<keyword>Error Keyword Match)|(?P<empty>Empty Response)|(?P<connect>Connect Timeout)"
+    r"|(?P<upstream>Upstream Error)"
+)
+_STATUS_CODE_PATTERN = re.compile(r"\b([45]\d\d)\b")
+# kind -> (reason, penalty, cooldown_seconds, detail) ; detail (untyped errors only): 0 none, 1 first ':' field, 2 everything after first ':'
+_ERROR_RULES = {
+    "ttft": ("超首token限制时长", 0.5, 0, 0), # Timeout is often transient
+    "total": ("超总限制时长", 0.5, 0, 0),
+    "status": ("触发错误状态码", 1.0, 0, 1),
+    "keyword": ("错误关键词", 10.0, 60, 1), # Treat custom errors as serious
+    "empty": ("空返回", 1.0, 0, 0),
+    "connect": ("连接超时", 0.5, 0, 0),
+    "upstream": ("上游错误", 1.0, 0, 2),
+}
+# Status-code / keyword overrides come from config (retries.status_policy / keyword_policy),
+# pre-built by config_manager as code|keyword -> (penalty, cooldown_seconds)
+_HARD_FAIL_CODES = frozenset((401, 403, 404, 429)) # Exclude for the entire request
+_ROUND_FAIL_KINDS = frozenset(("status", "keyword", "ttft", "total", "connect")) # Skip for the rest of the round
+
+# Anthropic usage key -> OpenAI usage key
+_OAI_USAGE_KEYS = (("input_tokens", "prompt_tokens"), ("output_tokens", "completion_tokens"))
+_OAI_USAGE_MAP = dict(_OAI_USAGE_KEYS)
+
+# Resolved upstream target for a (provider, model) entry; label is None for the default upstream
+_Route = collections.namedtuple("_Route", "base_url api_key protocol label")
+
+class _SSEParser:
+    """Incremental SSE stage-1 parser: feed raw bytes, get back complete `data: ` payloads.
+    
+    Works a whole network chunk per call, so the per-frame cost is a find/slice on a
+    bytearray rather than a generator resume. '\n' never occurs inside a UTF-8 multi-byte
+    sequence, so lines are split before decoding. `[DONE]` markers are dropped.
+    
+    Each byte is scanned for '\n' once: a partial trailing line is not re-searched when
+    the next chunk arrives (search resumes at the old end of the buffer).
+    
+    When no partial line is pending (the usual case) and orjson is available, the chunk
+    is parsed in place and payloads are memoryviews into it, so no bytes are copied per
+    frame. Views are never taken over the bytearray: a live export would block resizing it."""
+    __slots__ = ("_buf", "_pos")
+    
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0 # Start of the first unconsumed line
+    
+    def feed(self, chunk: bytes) -> List[Union[bytes, memoryview]]:
+        buf = self._buf
+        if not buf and orjson is not None:
+            # Nothing carried over: scan the immutable chunk itself (orjson reads buffers)
+            src = chunk
+            view = memoryview(chunk)
+            scan = 0
+        else:
+            scan = len(buf) # Bytes before this hold no unconsumed '\n'
+            buf.extend(chunk)
+            src = buf
+            view = None
+        pos = self._pos
+        frames = []
+        find = src.find
+        while True:
+            nl = find(b"\n", scan)
+            if nl < 0:
+                break
+            start = pos
+            pos = scan = nl + 1
+            # Fast path: blank keep-alives and ': ping' comments are skipped without slicing
+            if nl == start or src[start] == 0x3A or (nl == start + 1 and src[start] == 0x0D):
+                continue
+            # SSE lines only ever carry an optional trailing '\r'; trim just that
+            end = nl - 1 if src[nl - 1] == 0x0D else nl
+            if src.startswith(b"data: ", start, end):
+                data = view[start + 6:end] if view is not None else src[start + 6:end]
+                if data != b"[DONE]":
+                    frames.append(data)
+        if view is not None:
+            # Keep only the trailing partial line, if any
+            if pos < len(chunk):
+                buf += view[pos:]
+            self._pos = 0
+            return frames
+        # Compact consumed bytes: free when drained, otherwise only once the dead prefix is large
+        if pos == len(buf):
+            buf.clear()
+            pos = 0
+        elif pos > 65536:
+            del buf[:pos]
+            pos = 0
+        self._pos = pos
+        return frames
+    
+    def flush(self) -> List[bytes]:
+        """Payload of a final line that had no trailing newline, if any."""
+        tail = self._buf[self._pos:]
+        if tail.endswith(b"\r"):
+            tail = tail[:-1]
+        self._buf.clear()
+        self._pos = 0
+        if tail.startswith(b"data: ") and tail[6:] != b"[DONE]":
+            return [tail[6:]]
+        return []
+
+class UpstreamError(Exception):
+    """Typed upstream failure raised by _call_upstream; str(e) keeps the legacy message format."""
+    __slots__ = ("reason_code", "status_code", "detail", "keyword")
+
+    def __init__(self, message: str, reason_code: str, status_code: Optional[int] = None, detail: str = "", keyword: Optional[str] = None):
+        super().__init__(message)
+        self.reason_code = reason_code # Key into _ERROR_RULES
+        self.status_code = status_code
+        self.detail = detail # Appended to the rule's reason text ("" for none)
+        self.keyword = keyword # Matched error keyword for "keyword" failures
+
+def _classify_error(error_msg: str, kind: Optional[str] = None, status_code: Optional[int] = None, keyword: Optional[str] = None, detail: Optional[str] = None):
+    """Classify an upstream failure into (kind, reason, penalty, cooldown_seconds, status_code).
+    
+    Typed errors pass kind/status_code/detail directly; otherwise all three are sniffed from the message."""
+    if kind is None:
+        m = _ERROR_PATTERN.search(error_msg)
+        kind = m.lastgroup if m else None
+        code_match = _STATUS_CODE_PATTERN.search(error_msg)
+        status_code = int(code_match.group(1)) if code_match else None
+    if kind is None:
+        return None, error_msg, 1.0, 0, status_code
+    
+    reason, penalty, cooldown, detail_rule = _ERROR_RULES[kind]
+    if detail is None and detail_rule and ":" in error_msg:
+        detail = error_msg.split(':', 2)[1].strip() if detail_rule == 1 else error_msg.split(':', 1)[1].strip()
+    if detail:
+        reason += f": {detail}"
+    if kind == "status":
+        penalty, cooldown = config_manager.status_policy.get(status_code, (penalty, cooldown))
+    elif kind == "keyword" and keyword:
+        penalty, cooldown = config_manager.keyword_policy.get(keyword, (penalty, cooldown))
+    return kind, reason, penalty, cooldown, status_code
+
+def _classify_exception(e: Exception):
+    """_classify_error for an exception: attribute reads for UpstreamError, message regex otherwise."""
+    if isinstance(e, UpstreamError):
+        return _classify_error("", e.reason_code, e.status_code, e.keyword, e.detail)
+    return _classify_error(str(e))
+
+@functools.lru_cache(maxsize=64)
+def _get_encoding(model: str):
+    """Cached tiktoken encoding per model name (None when tiktoken is unavailable)."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Unknown model: default to cl100k_base (gpt-4/3.5)
+        return tiktoken.get_encoding("cl100k_base")
+
+@functools.lru_cache(maxsize=64)
+def _mk_timeout(connect_ms: int, stream_ms: int) -> httpx.Timeout:
+    """Cached upstream timeouts: connect fails fast (TTFT limit), read/write/pool allow long generation."""
+    stream_sec = stream_ms / 1000.0
+    return httpx.Timeout(connect=connect_ms / 1000.0, read=stream_sec, write=stream_sec, pool=stream_sec)
+
+@functools.lru_cache(maxsize=64)
+def _auth_headers(api_key: str) -> Dict[str, str]:
+    """Cached request headers per API key. Shared across calls, so never mutate the result."""
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+
+def _anthropic_tool(func: Dict[str, Any]) -> Dict[str, Any]:
+    """OpenAI tool "function" block -> Anthropic tool definition."""
+    return {
+        "name": func.get("name"),
+        "description": func.get("description"),
+        "input_schema": func.get("parameters")
+    }
+
+def _chat_completion(resp_id: str, created_ts: int, model: str, message: Dict[str, Any], finish_reason: str, usage: Dict[str, Any], local_prompt_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """OpenAI chat.completion response built with a single dict literal (fixed key order).
+    
+    local_prompt_tokens tags responses whose usage was filled in locally (popped by _extract_usage)."""
+    resp = {
+        "id": resp_id,
+        "object": "chat.completion",
+        "created": created_ts,
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": usage
+    }
+    if local_prompt_tokens is not None:
+        resp["_local_prompt_tokens"] = local_prompt_tokens
+    return resp
+
 class ChatMessage(BaseModel):
     role: str
     content: Optional[str] = None
@@ -64,14 +288,30 @@ class ChatCompletionRequest(BaseModel):
 
 class RouterEngine:
     _client: Optional[httpx.AsyncClient] = None
+    _upstream_client: Optional[httpx.AsyncClient] = None # Shared verify=False client for _call_upstream (keepalive/HTTP2 across attempts)
     _model_stats: Dict[str, Dict[str, Any]] = {} # { "model_id": { "failures": 0.0, "success": 0, "last_updated": timestamp } }
     _stats_file: str = "model_stats.json"
-    _tokenizer = None
+    # SoA view of the hot adaptive-routing fields, aligned by _model_index (dict above stays the source for persistence/UI)
+    _model_index: Dict[str, int] = {} # { "model_id": slot }
+    _fs_array: np.ndarray = np.zeros(0, dtype=np.float64) # failure_score per slot
+    _cooldown_array: np.ndarray = np.zeros(0, dtype=np.float64) # cooldown_until per slot
+    _last_updated_array: np.ndarray = np.zeros(0, dtype=np.float64) # last_updated per slot
+    _model_ids: List[str] = [] # slot -> model_id
     _image_description_cache: Dict[str, Dict[str, Any]] = {} # { "image_url_or_path": { "description": "...", "timestamp": 1234567890 } }
     _image_cache_file: str = "image_description_cache.json"
     _model_usage_history: Dict[str, List[float]] = {} # { "model_id": [timestamp1, timestamp2, ...] } - 滑动窗口记录模型使用时间
     _USAGE_WINDOW_SECONDS: float = 60.0 # 追踪最近60秒内的使用情况
     _consecutive_model_history: List[str] = [] # 记录最近的模型使用历史（用于连续惩罚计算）
+    _display_cache: Dict[tuple, str] = {} # { (provider_label, model_id): "provider/model" } - interned display names
+    _DISPLAY_CACHE_SIZE: int = 1024
+    _route_table: Dict[tuple, _Route] = {} # { (provider_id, model_name): _Route } - valid for _route_version
+    _route_version: int = -1 # config_manager.version the route table was built for
+    _log_queue: Optional[asyncio.Queue] = None # Pending request-log rows, drained by _log_consumer
+    _log_task: Optional[asyncio.Task] = None
+    _LOG_QUEUE_SIZE: int = 10_000 # Backpressure: producers wait when this many rows are pending
+    _LOG_BATCH_SIZE: int = 128 # Max rows written per executemany/commit
+    _LOG_BATCH_WINDOW: float = 0.1 # Seconds to keep collecting after the first row of a batch
+    _PROMPT_PREVIEW_CHARS: int = 200 # Length of RequestLog.user_prompt_preview
     
     def _normalize_model_entry(self, item: Any) -> Dict[str, Any]:
         """Normalize any model entry to a consistent dictionary format with 'model' and 'provider' fields."""
@@ -113,12 +353,58 @@ class RouterEngine:
     
     def _extract_model_id(self, item: Any) -> str:
         """Extract a unique model ID for stats tracking (provider/model or just model)."""
+        # Interned so stats dicts and excluded/failed sets hit the identity fast path
         normalized = self._normalize_model_entry(item)
         if normalized["provider"] == "upstream":
-            return normalized["model"]
+            return sys.intern(normalized["model"])
         else:
-            return f"{normalized['provider']}/{normalized['model']}"
+            return sys.intern(f"{normalized['provider']}/{normalized['model']}")
     
+    def _display_name(self, provider_label: Optional[str], model_id: str) -> str:
+        """Interned "provider/model" label for logs and traces, cached per (provider, model)."""
+        key = (provider_label, model_id)
+        name = self._display_cache.get(key)
+        if name is None:
+            if len(self._display_cache) >= self._DISPLAY_CACHE_SIZE:
+                self._display_cache.clear()
+            # 对于 upstream 提供商，使用 "upstream" 作为前缀，便于在日志中识别
+            name = sys.intern(f"{provider_label or 'upstream'}/{model_id}")
+            self._display_cache[key] = name
+        return name
+
+    def _resolve_route(self, providers_cfg, provider_id: str, model_name: str) -> _Route:
+        """Preresolved provider route for a model entry; the table is dropped whenever the config version changes."""
+        if self._route_version != config_manager.version:
+            self._route_table = {}
+            self._route_version = config_manager.version
+        key = (provider_id, model_name)
+        route = self._route_table.get(key)
+        if route is None:
+            route = self._route_table[key] = self._build_route(providers_cfg, provider_id, model_name)
+        return route
+
+    def _build_route(self, providers_cfg, provider_id: str, model_name: str) -> _Route:
+        upstream = providers_cfg.upstream
+        # Model calls always go through the shared verify=False client, so verify_ssl is not part of a route
+        route = _Route(upstream.base_url, upstream.api_key, getattr(upstream, "protocol", "openai"), None)
+        
+        # Check if we are using a custom provider
+        if provider_id != "upstream":
+            provider = providers_cfg.custom.get(provider_id)
+            if provider is not None:
+                return _Route(provider.base_url, provider.api_key, getattr(provider, "protocol", "openai"), provider_id)
+            logger.warning(f"Provider '{provider_id}' not found for model '{model_name}'. Using default upstream.")
+        
+        # Check model_provider_map (for compatibility)
+        elif model_name in providers_cfg.map:
+            mapped_provider_id = providers_cfg.map[model_name]
+            provider = providers_cfg.custom.get(mapped_provider_id)
+            if provider is not None:
+                return _Route(provider.base_url, provider.api_key, getattr(provider, "protocol", "openai"), mapped_provider_id)
+            logger.warning(f"Mapped provider '{provider_id}' not found for model '{model_name}'. Using default upstream.")
+        
+        return route
+
     def _get_all_model_ids(self, config) -> List[str]:
         """Get all unique model IDs from config for stats initialization."""
         model_ids = []
@@ -128,19 +414,9 @@ class RouterEngine:
                 model_ids.append(self._extract_model_id(item))
         return model_ids
 
-    def _get_tokenizer(self, model: str):
-        if self._tokenizer: return self._tokenizer
-        if tiktoken:
-            try:
-                # Try to get specific encoding, default to cl100k_base (gpt-4/3.5)
-                self._tokenizer = tiktoken.encoding_for_model(model)
-            except:
-                self._tokenizer = tiktoken.get_encoding("cl100k_base")
-        return self._tokenizer
-
     def _count_tokens(self, text: str, model: str = "gpt-3.5-turbo") -> int:
         if not text: return 0
-        tokenizer = self._get_tokenizer(model)
+        tokenizer = _get_encoding(model)
         if tokenizer:
             return len(tokenizer.encode(text))
         else:
@@ -152,7 +428,7 @@ class RouterEngine:
         Count tokens for a list of messages (Chat format).
         Follows OpenAI logic: 3 tokens overhead per message + tokens in content.
         """
-        tokenizer = self._get_tokenizer(model)
+        tokenizer = _get_encoding(model)
         if not tokenizer:
             # Fallback: Sum chars of content + role
             total_chars = sum(len(str(m.get("content", ""))) + len(str(m.get("role", ""))) for m in messages)
@@ -171,6 +447,32 @@ class RouterEngine:
         num_tokens += 3  # <|start|>assistant<|message|>
         return num_tokens
 
+    def _count_usage_locally(self, messages: List[Dict[str, Any]], completion_text: str, model: str):
+        """(prompt_tokens, completion_tokens) by local tokenization. CPU-bound: call via asyncio.to_thread."""
+        return self._count_messages_tokens(messages, model), self._count_tokens(completion_text, model)
+
+    def _extract_usage(self, response_data: Dict[str, Any], messages: List[Dict[str, Any]], model: str, count_locally: bool = False):
+        """Return (prompt_tokens, completion_tokens, token_source) for a successful response.
+        
+        count_locally (general.count_tokens_locally) only affects what is logged: the usage
+        object sent to the client is never changed here."""
+        # Set by _call_upstream when it already filled in missing usage locally; never sent to the client
+        local_prompt_tokens = response_data.pop("_local_prompt_tokens", None)
+        usage = response_data.get("usage")
+        if usage and local_prompt_tokens is None:
+            return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), "upstream"
+        if not count_locally:
+            return 0, 0, "missing"
+        if usage:
+            # Already counted locally for the client response; reuse instead of re-tokenizing
+            return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), "local"
+        # Opt-in: full BPE pass over the prompt, only when upstream omitted usage
+        completion_content = ""
+        choices = response_data.get("choices")
+        if choices:
+            completion_content = choices[0]["message"].get("content", "")
+        return self._count_messages_tokens(messages, model), self._count_tokens(completion_content, model), "local"
+
     async def startup(self):
         """Initialize global HTTP client and model stats"""
         if self._client is None:
@@ -178,9 +480,19 @@ class RouterEngine:
             limits = httpx.Limits(max_keepalive_connections=20, max_connections=100)
             self._client = httpx.AsyncClient(limits=limits)
             logger.info("Global HTTP Client initialized")
-        
-        # Load stats from disk
-        self._load_stats()
+        if self._upstream_client is None:
+            # SSL verification is force-disabled for upstream calls; one pooled client instead of one per attempt
+            limits = httpx.Limits(max_keepalive_connections=200, max_connections=1000, keepalive_expiry=60.0)
+            self._upstream_client = httpx.AsyncClient(verify=False, http2=_HTTP2_AVAILABLE, limits=limits)
+            logger.info(f"Upstream HTTP Client initialized (HTTP/2: {_HTTP2_AVAILABLE})")
+        
+        # Start the batched request-log writer
+        if self._log_task is None:
+            self._log_queue = asyncio.Queue(maxsize=self._LOG_QUEUE_SIZE)
+            self._log_task = asyncio.create_task(self._log_consumer())
+        
+        # Load stats from disk (off the event loop)
+        await asyncio.to_thread(self._load_stats_sync)
         # Load image description cache from disk
         self._load_image_cache()
         
@@ -198,6 +510,7 @@ class RouterEngine:
                     "avg_response_time": 0.0,
                     "response_time_samples": []
                 }
+        self._rebuild_stats_arrays()
 
     async def shutdown(self):
         """Close global HTTP client"""
@@ -205,8 +518,16 @@ class RouterEngine:
             await self._client.aclose()
             self._client = None
             logger.info("Global HTTP Client closed")
-        # Save stats to disk
-        self._save_stats()
+        if self._upstream_client:
+            await self._upstream_client.aclose()
+            self._upstream_client = None
+        # Flush pending request logs and stop the writer
+        if self._log_task is not None:
+            await self._log_queue.put(None)
+            await self._log_task
+            self._log_task = None
+        # Save stats to disk (off the event loop)
+        await asyncio.to_thread(self._save_stats_sync)
         # Save image description cache to disk
         self._save_image_cache()
 
@@ -281,20 +602,28 @@ class RouterEngine:
         self._cleanup_model_usage_history()
         return len(self._model_usage_history.get(model_id, []))
 
-    def _load_stats(self):
+    def _load_stats_sync(self):
         if os.path.exists(self._stats_file):
             try:
-                with open(self._stats_file, 'r', encoding='utf-8') as f:
-                    self._model_stats = json.load(f)
+                with open(self._stats_file, 'rb', buffering=1 << 20) as f:
+                    raw = f.read()
+                self._model_stats = {sys.intern(k): v for k, v in _json_loads(raw).items()}
                 logger.info("Model stats loaded from disk")
             except Exception as e:
                 logger.error(f"Failed to load model stats: {e}")
                 self._model_stats = {}
 
-    def _save_stats(self):
+    def _save_stats_sync(self):
         try:
-            with open(self._stats_file, 'w', encoding='utf-8') as f:
-                json.dump(self._model_stats, f, indent=2)
+            # Serialize once, write in a single call, then atomically swap in
+            if orjson is not None:
+                data = orjson.dumps(self._model_stats, option=orjson.OPT_INDENT_2)
+            else:
+                data = json.dumps(self._model_stats, indent=2).encode("utf-8")
+            tmp_file = self._stats_file + ".tmp"
+            with open(tmp_file, 'wb', buffering=0) as f:
+                f.write(data)
+            os.replace(tmp_file, self._stats_file)
             logger.info("Model stats saved to disk")
         except Exception as e:
             logger.error(f"Failed to save model stats: {e}")
@@ -555,6 +884,47 @@ class RouterEngine:
         logger.info(f"[图片处理_DEBUG] _process_messages_with_images 执行完成，返回 {len(processed_messages)} 条消息")
         return processed_messages
 
+    def _rebuild_stats_arrays(self):
+        """Rebuild the SoA arrays and _model_index from _model_stats (after load/cleanup)."""
+        model_ids = list(self._model_stats.keys())
+        self._model_ids = model_ids
+        self._model_index = {m: i for i, m in enumerate(model_ids)}
+        self._fs_array = np.zeros(len(model_ids), dtype=np.float64)
+        self._cooldown_array = np.zeros(len(model_ids), dtype=np.float64)
+        self._last_updated_array = np.zeros(len(model_ids), dtype=np.float64)
+        for m in model_ids:
+            self._sync_stats_slot(m, self._get_model_stats(m))
+
+    def _stats_slot(self, model_id: str) -> int:
+        """Return the SoA slot for a model, appending a new one if the model is unseen."""
+        idx = self._model_index.get(model_id)
+        if idx is None:
+            idx = len(self._model_index)
+            self._model_index[model_id] = idx
+            self._model_ids.append(model_id)
+            self._fs_array = np.append(self._fs_array, 0.0)
+            self._cooldown_array = np.append(self._cooldown_array, 0.0)
+            self._last_updated_array = np.append(self._last_updated_array, time.time())
+        return idx
+
+    def _sync_stats_slot(self, model_id: str, stats: Dict[str, Any]):
+        """Write-through: mirror the dict fields used by adaptive routing into the arrays."""
+        idx = self._stats_slot(model_id)
+        self._fs_array[idx] = stats.get("failure_score", 0.0)
+        self._cooldown_array[idx] = stats.get("cooldown_until", 0)
+        self._last_updated_array[idx] = stats.get("last_updated", time.time())
+
+    def _in_cooldown(self, idx: int, now: float) -> bool:
+        """Read the cooldown cell for a slot directly, without _get_model_stats' side effects."""
+        return self._cooldown_array[idx] > now
+
+    def _bump_failure(self, idx: int, penalty: float, cooldown_seconds: int, now: float):
+        """Apply a failure penalty (and optional cooldown) to a slot in the SoA arrays."""
+        self._fs_array[idx] += penalty
+        if cooldown_seconds > 0:
+            self._cooldown_array[idx] = now + cooldown_seconds
+        self._last_updated_array[idx] = now
+
     def _get_model_stats(self, model_id: str) -> Dict[str, Any]:
         if model_id not in self._model_stats:
             self._model_stats[model_id] = {
@@ -566,6 +936,7 @@ class RouterEngine:
                 "avg_response_time": 0.0,
                 "response_time_samples": []
             }
+            self._stats_slot(model_id)
         
         # Backward compatibility / Migration
         stats = self._model_stats[model_id]
@@ -612,6 +983,27 @@ class RouterEngine:
                 stats["failure_score"] = max(0.0, stats["failure_score"] - decay_amount)
             
             stats["last_updated"] = now
+            self._sync_stats_slot(model_id, stats)
+
+    def _refresh_stats_bulk(self, now: float):
+        """Vectorised _refresh_stats: decay every tracked failure_score in one numpy pass."""
+        if not len(self._fs_array):
+            return
+        decay_rate = config_manager.get_config().health.decay_rate
+        
+        elapsed_min = (now - self._last_updated_array) / 60.0
+        mask = elapsed_min > 0.1 # Only update if meaningful time passed (>6s)
+        if not mask.any():
+            return
+        self._fs_array[mask] = np.maximum(0.0, self._fs_array[mask] - elapsed_min[mask] * decay_rate)
+        self._last_updated_array[mask] = now
+        
+        # Write back to the dict for persistence/UI
+        for i in np.flatnonzero(mask):
+            stats = self._model_stats.get(self._model_ids[i])
+            if stats is not None:
+                stats["failure_score"] = float(self._fs_array[i])
+                stats["last_updated"] = now
 
     def _record_success(self, model_id: str):
         self._refresh_stats(model_id) # Apply decay first
@@ -624,7 +1016,8 @@ class RouterEngine:
             stats["failure_score"] = max(0.0, stats["failure_score"] - 2.0)
             
         stats["last_updated"] = time.time()
-        self._save_stats() # Persist on change (optimize frequency if high traffic)
+        self._sync_stats_slot(model_id, stats)
+        self._save_stats_sync() # Persist on change (optimize frequency if high traffic)
 
     def _record_response_time(self, model_id: str, response_time_ms: float):
         stats = self._get_model_stats(model_id)
@@ -639,24 +1032,33 @@ class RouterEngine:
         stats["response_time_samples"] = samples
         stats["avg_response_time"] = sum(samples) / len(samples)
         
-        self._save_stats()
+        self._save_stats_sync()
 
     def _record_failure(self, model_id: str, penalty: float = 1.0, cooldown_seconds: int = 0):
         self._refresh_stats(model_id) # Apply decay first
         stats = self._get_model_stats(model_id)
         stats["failures"] += 1 # Integer counter (always increments)
-        stats["failure_score"] += penalty # Dynamic score (decays)
         
+        # Dynamic score (decays) and cooldown are updated on the arrays, then mirrored back
+        idx = self._stats_slot(model_id)
+        now = time.time()
+        self._bump_failure(idx, penalty, cooldown_seconds, now)
+        stats["failure_score"] = float(self._fs_array[idx])
         if cooldown_seconds > 0:
-            stats["cooldown_until"] = time.time() + cooldown_seconds
+            stats["cooldown_until"] = float(self._cooldown_array[idx])
             
-        stats["last_updated"] = time.time()
-        self._save_stats() # Persist on change
+        stats["last_updated"] = now
+        self._save_stats_sync() # Persist on change
 
     def get_all_stats(self) -> Dict[str, Dict[str, Any]]:
         # Refresh all stats before returning to UI
-        for m in list(self._model_stats.keys()):
-            self._refresh_stats(m)
+        now = time.time()
+        self._refresh_stats_bulk(now)
+        health_scores = np.where(self._cooldown_array > now, 0, (100.0 / (1.0 + self._fs_array * 0.2)).astype(np.int64))
+        for model_id, idx in self._model_index.items():
+            stats = self._model_stats.get(model_id)
+            if stats is not None:
+                stats["health_score"] = int(health_scores[idx])
         return self._model_stats
 
     def cleanup_stats(self):
@@ -681,7 +1083,8 @@ class RouterEngine:
                     "last_updated": time.time()
                 }
         
-        self._save_stats() # Persist after cleanup
+        self._rebuild_stats_arrays()
+        self._save_stats_sync() # Persist after cleanup
 
     def _get_sorted_models(self, models: List[Any], strategy: str) -> List[Any]:
         if not models:
@@ -715,6 +1118,8 @@ class RouterEngine:
             max_usage = max(all_usage_counts.values()) if all_usage_counts else 1
             
             weighted_models = []
+            consecutive_weight = config_manager.get_config().adaptive_weights.weight_consecutive_penalty
+            
             for m in models:
                 model_id = self._extract_model_id(m)
                 usage_count = all_usage_counts.get(model_id, 0)
@@ -726,9 +1131,6 @@ class RouterEngine:
                     weight = 1.0
                 
                 # 避免连续使用同一模型 - 基于历史记录计算权重
-                config = config_manager.get_config()
-                consecutive_weight = config.adaptive_weights.weight_consecutive_penalty
-                
                 if model_id in self._consecutive_model_history:
                     # 计算模型在历史记录中的出现次数
                     occurrence_count = self._consecutive_model_history.count(model_id)
@@ -789,7 +1191,6 @@ class RouterEngine:
             logger.info("🧠 使用自适应策略，计算各模型权重（随机数 + 健康度 + 响应时间 + 用户权重 + 负载均衡）...")
             logger.info(f"📊 权重占比: 随机数 {weights.weight_random} | 健康值 {weights.weight_health} | 响应速度 {weights.weight_speed} | 用户加权 {weights.weight_user}")
             
-            scored_models = []
             max_response_time_threshold = 30000.0
             
             # 权重配置
@@ -804,43 +1205,51 @@ class RouterEngine:
             all_usage_counts = {self._extract_model_id(m): self._get_model_usage_count(self._extract_model_id(m)) for m in models}
             max_usage = max(all_usage_counts.values()) if all_usage_counts else 1
             
-            for m in models:
-                model_id = self._extract_model_id(m)
-                self._refresh_stats(model_id)
+            model_ids = [self._extract_model_id(m) for m in models]
+            
+            # 健康度 / 冷却 / 随机因子 - 基于 SoA 数组向量化计算
+            slots = np.fromiter((self._stats_slot(m) for m in model_ids), dtype=np.intp, count=len(model_ids))
+            now = time.time()
+            self._refresh_stats_bulk(now)
+            fs = self._fs_array[slots]
+            cooldown_active = self._cooldown_array[slots] > now
+            health_scores = np.where(cooldown_active, 0, (100.0 / (1.0 + fs * 0.2)).astype(np.int64))
+            health_factors = health_scores / 100.0
+            random_factors = np.random.random(len(model_ids))
+            
+            speed_factors = np.empty(len(model_ids))
+            user_weights = np.empty(len(model_ids))
+            balance_factors = np.empty(len(model_ids))
+            consecutive_penalties = np.zeros(len(model_ids))
+            avg_response_times = np.empty(len(model_ids))
+            usage_counts = np.empty(len(model_ids), dtype=np.int64)
+            
+            for i, (m, model_id) in enumerate(zip(models, model_ids)):
                 stats = self._get_model_stats(model_id)
-                
                 normalized = self._normalize_model_entry(m)
-                provider_tag = f"[{normalized['provider']}]"
-                health_score = stats.get("health_score", 100)
-                cooldown_active = stats.get("cooldown_until", 0) > time.time()
-                
-                # 1. 随机因子 - 归一化到 [0, 1]
-                random_factor = random.random()
-                
-                # 2. 健康因子 - 归一化到 [0, 1]
-                health_factor = health_score / 100.0
                 
                 # 3. 响应速度因子 - 归一化到 [0, 1]
                 avg_response_time = stats.get("avg_response_time", 0.0)
+                avg_response_times[i] = avg_response_time
                 if avg_response_time > 0:
                     normalized_time = min(avg_response_time / max_response_time_threshold, 1.0)
-                    speed_factor = 1.0 - normalized_time
+                    speed_factors[i] = 1.0 - normalized_time
                 else:
-                    speed_factor = 0.8
+                    speed_factors[i] = 0.8
                 
                 # 4. 用户权重 - 归一化到 [0, 1]
                 user_weight = normalized.get("weight", 0.5)
-                user_weight = max(0.0, min(1.0, user_weight))
+                user_weights[i] = max(0.0, min(1.0, user_weight))
                 
                 # 5. 负载均衡因子 - 根据使用次数惩罚
-                usage_count = self._get_model_usage_count(model_id)
+                usage_count = all_usage_counts.get(model_id, 0)
+                usage_counts[i] = usage_count
                 if max_usage > 0:
-                    balance_factor = 1.0 - (usage_count / max_usage) * 0.7
+                    balance_factors[i] = 1.0 - (usage_count / max_usage) * 0.7
                 else:
-                    balance_factor = 1.0
+                    balance_factors[i] = 1.0
                 
                 # 6. 避免连续使用同一模型 - 基于历史记录计算惩罚
-                consecutive_penalty = 0.0
                 consecutive_weight = weights.weight_consecutive_penalty
                 
                 if model_id in self._consecutive_model_history:
@@ -855,32 +1264,31 @@ class RouterEngine:
                         penalty_factor = frequency * consecutive_weight * 2.0
                         if is_recent:
                             penalty_factor = penalty_factor * 1.5 + 0.2
-                        penalty_factor = min(penalty_factor, 0.8)
-                        consecutive_penalty = penalty_factor
-                
-                # 加权求和
-                base_score = (
-                    random_factor * WEIGHT_RANDOM +
-                    health_factor * WEIGHT_HEALTH +
-                    speed_factor * WEIGHT_SPEED +
-                    user_weight * WEIGHT_USER
-                )
-                
-                # 应用负载均衡和连续惩罚
-                score = (base_score * balance_factor) - consecutive_penalty
-                
-                status_icon = "🔴" if cooldown_active else "🟢"
+                        consecutive_penalties[i] = min(penalty_factor, 0.8)
+            
+            # 加权求和，应用负载均衡和连续惩罚
+            base_scores = (
+                random_factors * WEIGHT_RANDOM +
+                health_factors * WEIGHT_HEALTH +
+                speed_factors * WEIGHT_SPEED +
+                user_weights * WEIGHT_USER
+            )
+            scores = (base_scores * balance_factors) - consecutive_penalties
+            
+            for i, m in enumerate(models):
+                normalized = self._normalize_model_entry(m)
+                provider_tag = f"[{normalized['provider']}]"
+                status_icon = "🔴" if cooldown_active[i] else "🟢"
                 logger.info(
                     f"  {status_icon} {provider_tag} {normalized['model']} | "
-                    f"健康度: {health_score}% | 响应时间: {avg_response_time:.0f}ms | "
-                    f"使用次数: {usage_count} | 随机: {random_factor:.3f} | 健康: {health_factor:.3f} | "
-                    f"速度: {speed_factor:.3f} | 用户权重: {user_weight:.3f} | 均衡: {balance_factor:.3f} | "
-                    f"连续惩罚: {consecutive_penalty:.3f} | 最终得分: {score:.4f}"
+                    f"健康度: {health_scores[i]}% | 响应时间: {avg_response_times[i]:.0f}ms | "
+                    f"使用次数: {usage_counts[i]} | 随机: {random_factors[i]:.3f} | 健康: {health_factors[i]:.3f} | "
+                    f"速度: {speed_factors[i]:.3f} | 用户权重: {user_weights[i]:.3f} | 均衡: {balance_factors[i]:.3f} | "
+                    f"连续惩罚: {consecutive_penalties[i]:.3f} | 最终得分: {scores[i]:.4f}"
                 )
-                scored_models.append((score, m))
             
-            scored_models.sort(key=lambda x: x[0], reverse=True)
-            sorted_result = [m for _, m in scored_models]
+            # 稳定排序，得分相同时保持原始顺序
+            sorted_result = [models[i] for i in np.argsort(-scores, kind="stable")]
             
             logger.info("-" * 60)
             logger.info("✅ 自适应排序完成，最终尝试顺序:")
@@ -897,21 +1305,50 @@ class RouterEngine:
         return models
 
     def _extract_text_from_content(self, content: Any) -> str:
+        # Fast path: plain string content is by far the most common case
+        if type(content) is str:
+            return content
         if content is None:
             return ""
-        if isinstance(content, str):
-            return content
         if isinstance(content, list):
+            if not content:
+                return ""
             text_parts = []
             for item in content:
                 if isinstance(item, dict):
-                    if item.get("type") == "text":
-                        text_parts.append(item.get("text", ""))
-                    elif item.get("type") in ["image_url", "image"]:
-                        text_parts.append("[图片]")
+                    item_type = item.get("type")
+                    if item_type == "text":
+                        text_parts.append(item.get("text") or "")
+                    elif item_type in ("image_url", "image"):
+                        text_parts.append(_IMG_PLACEHOLDER)
             return "".join(text_parts)
         return str(content)
 
+    def _prompt_preview(self, content: Any) -> str:
+        """Like _extract_text_from_content, but stops after _PROMPT_PREVIEW_CHARS characters,
+        so large multi-part prompts are never joined in full just for the log preview."""
+        limit = self._PROMPT_PREVIEW_CHARS
+        if type(content) is str:
+            return content[:limit]
+        if isinstance(content, list):
+            text_parts = []
+            size = 0
+            for item in content:
+                if isinstance(item, dict):
+                    item_type = item.get("type")
+                    if item_type == "text":
+                        part = (item.get("text") or "")[:limit - size]
+                    elif item_type in ("image_url", "image"):
+                        part = _IMG_PLACEHOLDER
+                    else:
+                        continue
+                    text_parts.append(part)
+                    size += len(part)
+                    if size >= limit:
+                        break
+            return "".join(text_parts)[:limit]
+        return self._extract_text_from_content(content)[:limit]
+
     def _convert_content_to_v1_response(self, content: Any, mode: str = "input") -> List[Dict[str, Any]]:
         """
         Convert OpenAI content format to v1/responses format.
@@ -946,133 +1383,93 @@ class RouterEngine:
         """
         anthropic_messages = []
         system_prompt = None
-        
-        # Buffer for consecutive tool outputs to merge into one User message
-        tool_results_buffer = []
-        
-        def flush_tool_buffer():
-            nonlocal tool_results_buffer
-            if tool_results_buffer:
-                # Anthropic expects tool results to be USER messages
-                # But we should verify if the LAST message was a User message to merge?
-                # No, Anthropic documentation says:
-                # "Tool result messages should be alternating with Assistant messages"
-                # Actually, in the Messages API:
-                # User (with tool_result content) -> Assistant -> User...
-                # So if we have multiple tool results, they should be in ONE User message block.
-                # However, if the previous message was ALSO a User message (text), 
-                # we might need to merge them if Anthropic doesn't allow consecutive User messages.
-                # BUT: The standard flow is User -> Assistant(ToolUse) -> User(ToolResult).
-                # So the previous message MUST be Assistant.
-                # If we have consecutive Tool Results (parallel tools), they go into ONE User msg.
-                
-                # Check if the last message in anthropic_messages is a User message
-                if anthropic_messages and anthropic_messages[-1]["role"] == "user":
-                    # Merge into existing user message
-                    current_content = anthropic_messages[-1]["content"]
-                    if isinstance(current_content, list):
-                        current_content.extend(tool_results_buffer)
-                    elif isinstance(current_content, str):
-                        # Convert string content to list structure
-                        new_content = [{"type": "text", "text": current_content}]
-                        new_content.extend(tool_results_buffer)
-                        anthropic_messages[-1]["content"] = new_content
+
+        # Single pass: consecutive messages mapping to the same Anthropic role are
+        # grouped into one message (Anthropic rejects consecutive same-role messages).
+        # Tool results are USER content, so they merge with adjacent user turns.
+        current_role = None
+        current_parts: List[Dict[str, Any]] = []
+
+        def flush():
+            if current_parts:
+                if len(current_parts) == 1 and current_parts[0].get("type") == "text":
+                    content = current_parts[0].get("text", "")
                 else:
-                    # Create new user message
-                    anthropic_messages.append({
-                        "role": "user",
-                        "content": tool_results_buffer
-                    })
-                tool_results_buffer = []
+                    content = current_parts
+                anthropic_messages.append({"role": current_role, "content": content})
 
         for msg in openai_messages:
             role = msg.get("role")
             content = msg.get("content")
-            
+
             if role == "system":
-                # Extract system prompt
-                # Anthropic supports only one system prompt usually, or we join them?
-                # Using the last one or joining is common practice. Let's join if multiple.
+                # Anthropic supports only one system prompt; join if multiple
                 text_content = self._extract_text_from_content(content)
                 if system_prompt:
                     system_prompt += "\n" + text_content
                 else:
                     system_prompt = text_content
                 continue
-            
-            # If we encounter a non-tool message, flush any pending tool results
-            if role != "tool":
-                flush_tool_buffer()
 
             if role == "user":
-                # Check if previous message was also user, if so merge (Anthropic doesn't like consecutive User messages)
-                if anthropic_messages and anthropic_messages[-1]["role"] == "user":
-                     # Merge text content
-                     prev_content = anthropic_messages[-1]["content"]
-                     new_text = self._extract_text_from_content(content)
-                     
-                     if isinstance(prev_content, str):
-                         anthropic_messages[-1]["content"] = prev_content + "\n" + new_text
-                     elif isinstance(prev_content, list):
-                         prev_content.append({
-                             "type": "text",
-                             "text": new_text
-                         })
+                target_role = "user"
+                if isinstance(content, list):
+                    parts = [item for item in content if isinstance(item, dict)]
                 else:
-                    anthropic_messages.append({
-                        "role": "user",
-                        "content": content
-                    })
-            
+                    parts = [{"type": "text", "text": self._extract_text_from_content(content)}]
+
             elif role == "assistant":
-                # Handle tool_calls conversion
-                tool_calls = msg.get("tool_calls")
-                new_content = []
-                
+                target_role = "assistant"
+                parts = []
                 # 1. Text Content
                 if content:
-                    new_content.append({
+                    parts.append({
                         "type": "text",
-                        "text": content
+                        "text": self._extract_text_from_content(content)
                     })
-                
                 # 2. Tool Uses
+                tool_calls = msg.get("tool_calls")
                 if tool_calls:
                     for tc in tool_calls:
                         func = tc.get("function", {})
                         args_str = func.get("arguments", "{}")
                         try:
-                            args = json.loads(args_str)
+                            args = _json_loads(args_str)
                         except:
                             args = {}
-                            
-                        new_content.append({
+
+                        parts.append({
                             "type": "tool_use",
                             "id": tc.get("id"),
                             "name": func.get("name"),
                             "input": args
                         })
-                
-                anthropic_messages.append({
-                    "role": "assistant",
-                    "content": new_content
-                })
-            
+
             elif role == "tool":
-                # Convert to tool_result block and buffer it
-                tool_result = {
+                # Anthropic expects tool results inside a USER message
+                target_role = "user"
+                parts = [{
                     "type": "tool_result",
                     "tool_use_id": msg.get("tool_call_id"),
                     "content": self._extract_text_from_content(content)
-                }
-                # Handle error state? OpenAI doesn't explicitly have error in tool msg, 
-                # but sometimes content implies error. Anthropic has is_error field.
-                # For now, keep simple.
-                tool_results_buffer.append(tool_result)
-        
+                }]
+
+            else:
+                continue
+
+            if not parts:
+                continue
+
+            if target_role != current_role:
+                flush()
+                current_role = target_role
+                current_parts = parts
+            else:
+                current_parts.extend(parts)
+
         # Final flush
-        flush_tool_buffer()
-        
+        flush()
+
         return {
             "system": system_prompt,
             "messages": anthropic_messages
@@ -1080,14 +1477,16 @@ class RouterEngine:
 
     async def determine_level(self, messages: List[Dict[str, Any]], trace_callback=None) -> str:
         config = config_manager.get_config()
+        models_cfg = config.models
+        router_cfg = config.router
         
         # Optimization: If the last message is from a tool, it means we are in a function calling loop.
         # Skip router model and default to T2 (Active/Tool-Use) if configured, else fallback gracefully.
         if messages and messages[-1].get("role") == "tool":
             logger.info("Tool response detected. Skipping router.")
-            if config.models.t2:
+            if models_cfg.t2:
                 return "t2"
-            elif config.models.t3:
+            elif models_cfg.t3:
                 logger.info("T2 models empty, falling back to T3 for tool response.")
                 return "t3"
             else:
@@ -1095,7 +1494,7 @@ class RouterEngine:
                 return "t1"
         
         # 1. Use Router Model if enabled
-        if config.router.enabled:
+        if router_cfg.enabled:
             try:
                 # Log Router Start
                 start_t = time.time()
@@ -1104,7 +1503,14 @@ class RouterEngine:
 
                 # Get recent user context (last 3 user messages)
                 # Filter for user messages only as requested to avoid token overflow
-                user_msgs = [m for m in messages if m.get("role") == "user"][-3:]
+                # Walk backwards and stop at the third hit instead of scanning the whole history
+                user_msgs = []
+                for m in reversed(messages):
+                    if m.get("role") == "user":
+                        user_msgs.append(m)
+                        if len(user_msgs) == 3:
+                            break
+                user_msgs.reverse()
                 history_lines = []
                 for m in user_msgs:
                     content = self._extract_text_from_content(m.get("content"))
@@ -1114,7 +1520,7 @@ class RouterEngine:
                     history_lines.append(f"User: {content}")
                 history_text = "\n".join(history_lines)
                 
-                prompt = config.router.prompt_template.replace("{history}", history_text)
+                prompt = router_cfg.prompt_template.replace("{history}", history_text)
                 
                 # Use global client if available, else create one
                 if self._client is None: await self.startup()
@@ -1125,9 +1531,9 @@ class RouterEngine:
                 # verify_ssl = False (OLD)
                 
                 # Logic to inherit from Upstream if Router config is empty
-                base_url = config.router.base_url
-                api_key = config.router.api_key
-                should_verify_ssl = config.router.verify_ssl # Default True in config
+                base_url = router_cfg.base_url
+                api_key = router_cfg.api_key
+                should_verify_ssl = router_cfg.verify_ssl # Default True in config
 
                 if not base_url:
                     logger.info("Router Base URL is empty. Inheriting from Upstream Provider.")
@@ -1163,12 +1569,12 @@ class RouterEngine:
                     
                     # Print full debug info for user
                     masked_key = api_key[:8] + "***" if api_key else "None"
-                    logger.info(f"DEBUG: Router Request -> Model: {config.router.model}, URL: {url}, Auth: {masked_key}")
+                    logger.info(f"DEBUG: Router Request -> Model: {router_cfg.model}, URL: {url}, Auth: {masked_key}, History Chars: {len(history_text)}")
                     
                     resp = await client_to_use.post(
                         url,
                         json={
-                            "model": config.router.model,
+                            "model": router_cfg.model,
                             "messages": [{"role": "user", "content": prompt}],
                             "max_tokens": 10,
                             "temperature": 0.0
@@ -1219,7 +1625,7 @@ class RouterEngine:
             logger.info("Router disabled. Defaulting to T1 level for fault tolerance.")
             return "t1"
 
-    async def route_request(self, request: ChatCompletionRequest, background_tasks: BackgroundTasks):
+    async def route_request(self, request: ChatCompletionRequest):
         trace_logger.log_separator("=")
         start_time = time.time() # Request Arrived (T0)
         trace_id = str(uuid.uuid4())
@@ -1247,49 +1653,40 @@ class RouterEngine:
                 event["reason"] = reason
             trace_events.append(event)
 
+        def trace_both(stage, abs_time, duration, st, rc, details="", model=None, reason=None):
+            # Live trace line + DB trace event for the same timestamp
+            trace_logger.log(trace_id, stage, abs_time, duration, st, rc, details=details)
+            add_trace_event(stage, abs_time, duration, st, rc, model=model, reason=reason)
+
         # 1. Log: Request Received
         trace_logger.log(trace_id, "REQ_RECEIVED", start_time, 0, "success")
         # Log REQ_RECEIVED for DB trace
         add_trace_event("REQ_RECEIVED", start_time, 0, "success", 0)
         
         config = config_manager.get_config()
+        models_cfg = config.models
+        timeouts_connect = config.timeouts.connect
+        timeouts_gen = config.timeouts.generation
+        retry_rounds = config.retries.rounds
+        retry_max = config.retries.max_retries
+        providers_cfg = config.providers
+        count_tokens_locally = config.general.count_tokens_locally
         
         logger.info("")
         logger.info("📊 正在确定请求级别...")
         level = await self.determine_level(request.messages, trace_callback=add_trace_event)
         logger.info(f"✅ 请求级别确定: {level.upper()}")
         
-        models = []
-        timeout_ms = 0
-        stream_timeout_ms = 0
-        
         # 根据策略类型选择不同的重试配置
         strategy = config.routing_strategies.get(level, "sequential")
         
-        if level == "t1":
-            models = config.models.t1
-            timeout_ms = config.timeouts.connect.get("t1", 5000)
-            stream_timeout_ms = config.timeouts.generation.get("t1", 300000)
-            if strategy == "sequential":
-                max_attempts = config.retries.rounds.get("t1", 1)
-            else:
-                max_attempts = config.retries.max_retries.get("t1", 3)
-        elif level == "t2":
-            models = config.models.t2
-            timeout_ms = config.timeouts.connect.get("t2", 15000)
-            stream_timeout_ms = config.timeouts.generation.get("t2", 300000)
-            if strategy == "sequential":
-                max_attempts = config.retries.rounds.get("t2", 1)
-            else:
-                max_attempts = config.retries.max_retries.get("t2", 3)
-        else: # t3
-            models = config.models.t3
-            timeout_ms = config.timeouts.connect.get("t3", 30000)
-            stream_timeout_ms = config.timeouts.generation.get("t3", 300000)
-            if strategy == "sequential":
-                max_attempts = config.retries.rounds.get("t3", 1)
-            else:
-                max_attempts = config.retries.max_retries.get("t3", 3)
+        models = getattr(models_cfg, level)
+        timeout_ms = timeouts_connect.get(level, DEFAULT_CONNECT[level])
+        stream_timeout_ms = timeouts_gen.get(level, 300000)
+        if strategy == "sequential":
+            max_attempts = retry_rounds.get(level, 1)
+        else:
+            max_attempts = retry_max.get(level, 3)
             
         if not models:
             raise HTTPException(status_code=500, detail=f"No models configured for level {level}")
@@ -1304,8 +1701,29 @@ class RouterEngine:
         # Log if strategy reordered them
         if strategy != "sequential" and sorted_models != models:
              logger.info(f"Models reordered by strategy '{strategy}' for level {level}: {sorted_models}")
-        models = sorted_models
+        
+        # 冷却过滤：每个请求只检查一次，循环内不再逐个读取完整统计
+        # stats 槽位会在 cleanup_stats() 时重新编号，所以循环内每次尝试都重新解析槽位；
+        # 排除位图使用本请求内的位编号 (同一统计ID共享一位)，不受重新编号影响
+        now = time.time()
+        models = []
+        model_ids = []
+        model_bits = []
+        bit_index: Dict[str, int] = {}
+        for model_item in sorted_models:
+            model_id = self._extract_model_id(model_item)
+            slot = self._stats_slot(model_id)
+            if self._in_cooldown(slot, now):
+                cooldown_remaining = int(self._cooldown_array[slot] - now)
+                logger.info(f"⏸️ 跳过冷却中的模型: {model_id} (剩余 {cooldown_remaining} 秒)")
+            else:
+                models.append(model_item)
+                model_ids.append(model_id)
+                model_bits.append(1 << bit_index.setdefault(model_id, len(bit_index)))
 
+        # Serialize the request once; attempts reuse it (with swapped messages when images are processed)
+        request_dict = request.model_dump(exclude_none=True)
+        
         has_images = self._has_image_content(request.messages)
         transcribed_messages = None
         image_cached = False
@@ -1331,14 +1749,15 @@ class RouterEngine:
 
         last_error = None
         last_stack_trace = None
-        user_prompt = self._extract_text_from_content(request.messages[-1].get("content")) if request.messages else ""
+        user_prompt = self._prompt_preview(request.messages[-1].get("content")) if request.messages else ""
         
         # Ensure max_attempts is at least 1
         if max_attempts < 1: max_attempts = 1
         
         retry_count = 0
         attempt_errors = []
-        excluded_models = set()
+        # Bitmasks over this request's model_bits (one bit per stats ID); Python ints grow past 64 models
+        excluded_mask = 0
         
         # 对于顺序模式，需要嵌套循环（轮数 × 模型数）
         # 对于自适应/随机模式，只需要单层循环（最多尝试 max_attempts 个模型）
@@ -1352,7 +1771,7 @@ class RouterEngine:
             
             attempt_idx = 0
             for round_idx in range(max_attempts):
-                round_failed_models = set()
+                round_failed_mask = 0
                 if round_idx > 0:
                     logger.info(f"Starting Round {round_idx + 1}/{max_attempts} for level {level}")
                     
@@ -1361,7 +1780,8 @@ class RouterEngine:
                     normalized = self._normalize_model_entry(model_item)
                     model_name = normalized["model"]
                     provider_id = normalized["provider"]
-                    model_id_for_stats = self._extract_model_id(model_item)
+                    model_id_for_stats = model_ids[model_idx]
+                    model_bit = model_bits[model_idx]
                     
                     provider_tag = f"[{provider_id}]"
                     
@@ -1370,16 +1790,17 @@ class RouterEngine:
                     logger.info(f"  │    统计ID: {model_id_for_stats}")
                     
                     # Skip hard failures always, skip soft failures only for this round
-                    if model_id_for_stats in excluded_models or model_id_for_stats in round_failed_models:
-                        reason = "排除列表" if model_id_for_stats in excluded_models else "本回合失败"
+                    if (excluded_mask | round_failed_mask) & model_bit:
+                        reason = "排除列表" if excluded_mask & model_bit else "本回合失败"
                         logger.info(f"  │ ❌ 跳过: {reason}")
                         logger.info(f"  └──────────────────────────────────────────────")
                         continue
                     
-                    # Check for active cooldown (Global Health Check)
-                    stats = self._get_model_stats(model_id_for_stats)
-                    if stats.get("cooldown_until", 0) > time.time():
-                        cooldown_remaining = int(stats["cooldown_until"] - time.time())
+                    # Check for cooldown entered during this request (e.g. keyword match in an earlier round)
+                    now = time.time()
+                    model_slot = self._stats_slot(model_id_for_stats)
+                    if self._in_cooldown(model_slot, now):
+                        cooldown_remaining = int(self._cooldown_array[model_slot] - now)
                         logger.info(f"  │ ❌ 跳过: 冷却中 (剩余 {cooldown_remaining} 秒)")
                         logger.info(f"  └──────────────────────────────────────────────")
                         continue
@@ -1391,45 +1812,14 @@ class RouterEngine:
                     try:
                         # Resolve Provider
                         target_model_id = model_name
-                        target_base_url = config.providers.upstream.base_url
-                        target_api_key = config.providers.upstream.api_key
-                        target_protocol = getattr(config.providers.upstream, "protocol", "openai")
-                        target_verify_ssl = getattr(config.providers.upstream, "verify_ssl", True)
-                        provider_label = None
-                        
-                        if provider_id != "upstream":
-                            if provider_id in config.providers.custom:
-                                provider = config.providers.custom[provider_id]
-                                target_base_url = provider.base_url
-                                target_api_key = provider.api_key
-                                target_protocol = getattr(provider, "protocol", "openai")
-                                target_verify_ssl = getattr(provider, "verify_ssl", True)
-                                provider_label = provider_id
-                            else:
-                                logger.warning(f"Provider '{provider_id}' not found for model '{model_name}'. Using default upstream.")
-                                pass 
-
-                        elif model_name in config.providers.map:
-                            mapped_provider_id = config.providers.map[model_name]
-                            if mapped_provider_id in config.providers.custom:
-                                provider = config.providers.custom[mapped_provider_id]
-                                target_base_url = provider.base_url
-                                target_api_key = provider.api_key
-                                target_protocol = getattr(provider, "protocol", "openai")
-                                target_verify_ssl = getattr(provider, "verify_ssl", True)
-                                provider_label = mapped_provider_id
-                            else:
-                                 logger.warning(f"Mapped provider '{provider_id}' not found for model '{model_name}'. Using default upstream.")
+                        target_base_url, target_api_key, target_protocol, provider_label = self._resolve_route(providers_cfg, provider_id, model_name)
 
-                        if provider_label:
-                            display_model_name = f"{provider_label}/{target_model_id}"
-                        else:
-                            display_model_name = f"upstream/{target_model_id}"
+                        display_model_name = self._display_name(provider_label, target_model_id)
 
-                        call_start_time = time.time()
+                        # Reuse the cooldown-check timestamp: one clock read per attempt
+                        call_start_time = now
                         duration_since_req = (call_start_time - start_time) * 1000
-                        trace_logger.log(trace_id, "MODEL_CALL_START", call_start_time, duration_since_req, "success", retry_count, details=f"正在尝试: {display_model_name}")
-                        add_trace_event("MODEL_CALL_START", call_start_time, duration_since_req, "success", retry_count, model=display_model_name)
+                        trace_both("MODEL_CALL_START", call_start_time, duration_since_req, "success", retry_count, details=f"正在尝试: {display_model_name}", model=display_model_name)
                         
                         logger.info("")
                         logger.info("  " + "─" * 56)
@@ -1442,7 +1832,7 @@ class RouterEngine:
                         model_multimodal = normalized.get("multimodal", True)
                         logger.info(f"  [图片处理_DEBUG] has_images: {has_images}, model_multimodal: {model_multimodal}")
                         
-                        processed_request = request
+                        processed_request = request_dict
                         log_messages = request.messages
                         if has_images:
                             try:
@@ -1457,23 +1847,7 @@ class RouterEngine:
                                         preserve_original=False
                                     )
                                     logger.info(f"  [图片处理_DEBUG] _process_messages_with_images 完成，构建新请求")
-                                    processed_request = ChatCompletionRequest(
-                                        model=request.model,
-                                        messages=processed_messages,
-                                        temperature=request.temperature,
-                                        top_p=request.top_p,
-                                        n=request.n,
-                                        stream=request.stream,
-                                        stop=request.stop,
-                                        max_tokens=request.max_tokens,
-                                        presence_penalty=request.presence_penalty,
-                                        frequency_penalty=request.frequency_penalty,
-                                        logit_bias=request.logit_bias,
-                                        user=request.user,
-                                        tools=request.tools,
-                                        tool_choice=request.tool_choice,
-                                        response_format=request.response_format
-                                    )
+                                    processed_request = {**request_dict, "messages": processed_messages}
                                     log_messages = processed_messages
                                     
                                     image_end_time = time.time()
@@ -1491,23 +1865,7 @@ class RouterEngine:
                                         preserve_original=True
                                     )
                                     logger.info(f"  [图片处理_DEBUG] _process_messages_with_images 完成，构建新请求")
-                                    processed_request = ChatCompletionRequest(
-                                        model=request.model,
-                                        messages=processed_messages,
-                                        temperature=request.temperature,
-                                        top_p=request.top_p,
-                                        n=request.n,
-                                        stream=request.stream,
-                                        stop=request.stop,
-                                        max_tokens=request.max_tokens,
-                                        presence_penalty=request.presence_penalty,
-                                        frequency_penalty=request.frequency_penalty,
-                                        logit_bias=request.logit_bias,
-                                        user=request.user,
-                                        tools=request.tools,
-                                        tool_choice=request.tool_choice,
-                                        response_format=request.response_format
-                                    )
+                                    processed_request = {**request_dict, "messages": processed_messages}
                                     log_messages = processed_messages
                                     
                                     image_end_time = time.time()
@@ -1519,7 +1877,7 @@ class RouterEngine:
                                 logger.error(f"  [图片处理_DEBUG] 图片处理流程完整堆栈跟踪:\n{traceback.format_exc()}")
                                 logger.warning(f"  [图片处理] 图片处理失败，将使用原始请求继续尝试")
                         
-                        response_data = await self._call_upstream(processed_request, target_model_id, target_base_url, target_api_key, timeout_ms, stream_timeout_ms, trace_id, retry_count, call_start_time, add_trace_event, protocol=target_protocol, verify_ssl=target_verify_ssl)
+                        response_data = await self._call_upstream(processed_request, target_model_id, target_base_url, target_api_key, timeout_ms, stream_timeout_ms, trace_id, retry_count, call_start_time, add_trace_event, protocol=target_protocol)
                         
                         self._record_success(model_id_for_stats)
                         self._record_model_usage(model_id_for_stats)
@@ -1529,22 +1887,7 @@ class RouterEngine:
                         
                         self._record_response_time(model_id_for_stats, duration)
                         
-                        token_source = "upstream"
-                        if "usage" in response_data:
-                             usage = response_data["usage"]
-                             prompt_tokens = usage.get("prompt_tokens", 0)
-                             completion_tokens = usage.get("completion_tokens", 0)
-                        else:
-                             token_source = "local"
-                             prompt_tokens = 0
-                             completion_tokens = 0
-                             if "usage" not in response_data:
-                                 req_messages = request.messages
-                                 prompt_tokens = self._count_messages_tokens(req_messages, model_name)
-                                 completion_content = ""
-                                 if "choices" in response_data and response_data["choices"]:
-                                     completion_content = response_data["choices"][0]["message"].get("content", "")
-                                 completion_tokens = self._count_tokens(completion_content, model_name)
+                        prompt_tokens, completion_tokens, token_source = self._extract_usage(response_data, request.messages, model_name, count_tokens_locally)
 
                         logger.info("")
                         logger.info("  " + "─" * 56)
@@ -1559,12 +1902,11 @@ class RouterEngine:
                         logger.info("╚" + "═" * 58 + "╝")
                         logger.info("")
 
-                        background_tasks.add_task(
-                            self._log_request,
+                        await self._log_request(
                             level, display_model_name, duration, "success", 
-                            self._extract_text_from_content(log_messages[-1].get("content")) if log_messages else user_prompt, 
-                            json.dumps({**request.model_dump(), "messages": log_messages}), 
-                            json.dumps(response_data), 
+                            self._prompt_preview(log_messages[-1].get("content")) if log_messages else user_prompt, 
+                            {**request_dict, "messages": log_messages}, 
+                            response_data, 
                             trace_events, None, retry_count, prompt_tokens, completion_tokens, token_source
                         )
                         
@@ -1574,50 +1916,7 @@ class RouterEngine:
                         fail_time = time.time()
                         fail_duration = (fail_time - call_start_time) * 1000
                         
-                        error_msg = str(e)
-                        reason = "Unknown Error"
-                        penalty = 1.0
-                        cooldown = 0
-                        
-                        if "TTFT Timeout" in error_msg:
-                            reason = "超首token限制时长"
-                            penalty = 0.5
-                        elif "Total Timeout" in error_msg:
-                            reason = "超总限制时长"
-                            penalty = 0.5
-                        elif "Status Code Error" in error_msg:
-                             reason = "触发错误状态码"
-                             if ":" in error_msg:
-                                 code_part = error_msg.split(':')[1].strip()
-                                 reason += f": {code_part}"
-                                 if "429" in code_part:
-                                     penalty = 10.0
-                                     cooldown = 60
-                                 elif "401" in code_part or "403" in code_part:
-                                     penalty = 50.0
-                                     cooldown = 300
-                                 elif code_part.strip().startswith("5"):
-                                     penalty = 1.0
-                        elif "Error Keyword Match" in error_msg:
-                             reason = "错误关键词"
-                             if ":" in error_msg:
-                                 reason += f": {error_msg.split(':')[1].strip()}"
-                             penalty = 10.0
-                             cooldown = 60
-                        elif "Empty Response" in error_msg:
-                            reason = "空返回"
-                            penalty = 1.0
-                        elif "Connect Timeout" in error_msg:
-                            reason = "连接超时"
-                            penalty = 0.5
-                        elif "Upstream Error" in error_msg:
-                             reason = "上游错误"
-                             if ":" in error_msg:
-                                 reason += f": {error_msg.split(':', 1)[1].strip()}"
-                             penalty = 1.0
-                        else:
-                            reason = error_msg
-                            penalty = 1.0
+                        kind, reason, penalty, cooldown, status_code = _classify_exception(e)
 
                         logger.info("")
                         logger.info("  " + "─" * 56)
@@ -1629,8 +1928,7 @@ class RouterEngine:
                             logger.info(f"  🕒  冷却: {cooldown}秒")
                         logger.info("  " + "─" * 56)
                         
-                        trace_logger.log(trace_id, "MODEL_FAIL", fail_time, fail_duration, "fail", retry_count, details=f"原因: {reason} | 模型: {display_model_name}")
-                        add_trace_event("MODEL_FAIL", fail_time, fail_duration, "fail", retry_count, model=display_model_name, reason=reason)
+                        trace_both("MODEL_FAIL", fail_time, fail_duration, "fail", retry_count, details=f"原因: {reason} | 模型: {display_model_name}", model=display_model_name, reason=reason)
                         
                         self._record_failure(model_id_for_stats, penalty=penalty, cooldown_seconds=cooldown)
 
@@ -1639,14 +1937,10 @@ class RouterEngine:
                              detailed_error += f" ({str(e)})"
                         attempt_errors.append(detailed_error)
 
-                        if "401" in error_msg or "403" in error_msg or "404" in error_msg:
-                             excluded_models.add(model_id_for_stats)
-                        elif "429" in error_msg:
-                             excluded_models.add(model_id_for_stats)
-                        elif "Error Keyword Match" in error_msg or "Status Code Error" in error_msg:
-                             round_failed_models.add(model_id_for_stats)
-                        elif "503" in error_msg or "Timeout" in error_msg:
-                             round_failed_models.add(model_id_for_stats)
+                        if status_code in _HARD_FAIL_CODES:
+                             excluded_mask |= model_bit
+                        elif kind in _ROUND_FAIL_KINDS or status_code == 503:
+                             round_failed_mask |= model_bit
 
                         last_error = e
                         last_stack_trace = traceback.format_exc()
@@ -1662,7 +1956,7 @@ class RouterEngine:
             logger.info("=" * 60)
             
             attempt_idx = 0
-            for model_item in models:
+            for model_idx, model_item in enumerate(models):
                 if attempt_idx >= max_attempts:
                     logger.info(f"  ⚠️ 已达到最大尝试次数 {max_attempts}，停止尝试")
                     break
@@ -1671,7 +1965,8 @@ class RouterEngine:
                 normalized = self._normalize_model_entry(model_item)
                 model_name = normalized["model"]
                 provider_id = normalized["provider"]
-                model_id_for_stats = self._extract_model_id(model_item)
+                model_id_for_stats = model_ids[model_idx]
+                model_bit = model_bits[model_idx]
                 
                 provider_tag = f"[{provider_id}]"
                 
@@ -1679,14 +1974,15 @@ class RouterEngine:
                 logger.info(f"  │ 🧪 尝试 {attempt_idx}/{max_attempts}: {provider_tag} {model_name}")
                 logger.info(f"  │    统计ID: {model_id_for_stats}")
                 
-                if model_id_for_stats in excluded_models:
+                if excluded_mask & model_bit:
                     logger.info(f"  │ ❌ 跳过: 排除列表")
                     logger.info(f"  └──────────────────────────────────────────────")
                     continue
                 
-                stats = self._get_model_stats(model_id_for_stats)
-                if stats.get("cooldown_until", 0) > time.time():
-                    cooldown_remaining = int(stats["cooldown_until"] - time.time())
+                now = time.time()
+                model_slot = self._stats_slot(model_id_for_stats)
+                if self._in_cooldown(model_slot, now):
+                    cooldown_remaining = int(self._cooldown_array[model_slot] - now)
                     logger.info(f"  │ ❌ 跳过: 冷却中 (剩余 {cooldown_remaining} 秒)")
                     logger.info(f"  └──────────────────────────────────────────────")
                     continue
@@ -1695,58 +1991,21 @@ class RouterEngine:
                 logger.info(f"  └──────────────────────────────────────────────")
 
                 try:
-                    # Resolve Provider
+                    # Resolve Provider (one lookup in the preresolved route table)
                     target_model_id = model_name
-                    target_base_url = config.providers.upstream.base_url
-                    target_api_key = config.providers.upstream.api_key
-                    target_protocol = getattr(config.providers.upstream, "protocol", "openai")
-                    # Default to upstream verify_ssl (fallback to True if missing in config object)
-                    target_verify_ssl = getattr(config.providers.upstream, "verify_ssl", True)
-                    provider_label = None
-                    
-                    # Check if we are using a custom provider
-                    if provider_id != "upstream":
-                        if provider_id in config.providers.custom:
-                            provider = config.providers.custom[provider_id]
-                            target_base_url = provider.base_url
-                            target_api_key = provider.api_key
-                            target_protocol = getattr(provider, "protocol", "openai")
-                            target_verify_ssl = getattr(provider, "verify_ssl", True)
-                            provider_label = provider_id
-                        else:
-                            logger.warning(f"Provider '{provider_id}' not found for model '{model_name}'. Using default upstream.")
-                            pass 
-
-                    # Check model_provider_map (for compatibility)
-                    elif model_name in config.providers.map:
-                        mapped_provider_id = config.providers.map[model_name]
-                        if mapped_provider_id in config.providers.custom:
-                            provider = config.providers.custom[mapped_provider_id]
-                            target_base_url = provider.base_url
-                            target_api_key = provider.api_key
-                            target_protocol = getattr(provider, "protocol", "openai")
-                            target_verify_ssl = getattr(provider, "verify_ssl", True)
-                            provider_label = mapped_provider_id
-                        else:
-                             logger.warning(f"Mapped provider '{provider_id}' not found for model '{model_name}'. Using default upstream.")
+                    target_base_url, target_api_key, target_protocol, provider_label = self._resolve_route(providers_cfg, provider_id, model_name)
 
                     # Construct Display Model Name (Provider/Model)
-                    if provider_label:
-                        display_model_name = f"{provider_label}/{target_model_id}"
-                    else:
-                        # 对于 upstream 提供商，使用 "upstream" 作为前缀，便于在日志中识别
-                        display_model_name = f"upstream/{target_model_id}"
+                    display_model_name = self._display_name(provider_label, target_model_id)
 
-                    # 2. Log: Model Call Start
-                    call_start_time = time.time()
+                    # 2. Log: Model Call Start (reuses the cooldown-check timestamp)
+                    call_start_time = now
                     # Fix: Duration should be relative to previous step or just 0?
                     # The prompt says: "框架接收→首次调用"
                     # So duration_since_req is correct for "Framework Received -> First Call".
                     
                     duration_since_req = (call_start_time - start_time) * 1000
-                    trace_logger.log(trace_id, "MODEL_CALL_START", call_start_time, duration_since_req, "success", retry_count, details=f"正在尝试: {display_model_name}")
-                    
-                    add_trace_event("MODEL_CALL_START", call_start_time, duration_since_req, "success", retry_count, model=display_model_name)
+                    trace_both("MODEL_CALL_START", call_start_time, duration_since_req, "success", retry_count, details=f"正在尝试: {display_model_name}", model=display_model_name)
                     
                     logger.info("")
                     logger.info("  " + "─" * 56)
@@ -1757,32 +2016,16 @@ class RouterEngine:
                     has_images = self._has_image_content(request.messages)
                     model_multimodal = normalized.get("multimodal", True)
                     
-                    processed_request = request
+                    processed_request = request_dict
                     log_messages = request.messages
                     if has_images:
                         if image_cached and transcribed_messages is not None:
                             logger.info(f"  [图片处理] 使用缓存的转述内容")
-                            processed_request = ChatCompletionRequest(
-                                model=request.model,
-                                messages=transcribed_messages,
-                                temperature=request.temperature,
-                                top_p=request.top_p,
-                                n=request.n,
-                                stream=request.stream,
-                                stop=request.stop,
-                                max_tokens=request.max_tokens,
-                                presence_penalty=request.presence_penalty,
-                                frequency_penalty=request.frequency_penalty,
-                                logit_bias=request.logit_bias,
-                                user=request.user,
-                                tools=request.tools,
-                                tool_choice=request.tool_choice,
-                                response_format=request.response_format
-                            )
+                            processed_request = {**request_dict, "messages": transcribed_messages}
                             log_messages = transcribed_messages
                         elif model_multimodal:
                             logger.info(f"  [图片处理] 模型支持多模态，直接使用原始图片")
-                            processed_request = request
+                            processed_request = request_dict
                             log_messages = request.messages
                         else:
                             logger.info(f"  [图片处理] 模型不支持多模态，开始图片转述并缓存...")
@@ -1796,23 +2039,7 @@ class RouterEngine:
                             transcribed_messages = processed_messages
                             image_cached = True
                             
-                            processed_request = ChatCompletionRequest(
-                                model=request.model,
-                                messages=processed_messages,
-                                temperature=request.temperature,
-                                top_p=request.top_p,
-                                n=request.n,
-                                stream=request.stream,
-                                stop=request.stop,
-                                max_tokens=request.max_tokens,
-                                presence_penalty=request.presence_penalty,
-                                frequency_penalty=request.frequency_penalty,
-                                logit_bias=request.logit_bias,
-                                user=request.user,
-                                tools=request.tools,
-                                tool_choice=request.tool_choice,
-                                response_format=request.response_format
-                            )
+                            processed_request = {**request_dict, "messages": processed_messages}
                             log_messages = processed_messages
                             
                             image_end_time = time.time()
@@ -1820,7 +2047,7 @@ class RouterEngine:
                             add_trace_event("IMAGE_TRANSCRIBE_DONE", image_end_time, image_duration, "success", retry_count)
                             logger.info(f"  [图片处理] 图片转述完成并缓存，后续模型将使用缓存内容")
                     
-                    response_data = await self._call_upstream(processed_request, target_model_id, target_base_url, target_api_key, timeout_ms, stream_timeout_ms, trace_id, retry_count, call_start_time, add_trace_event, protocol=target_protocol, verify_ssl=target_verify_ssl)
+                    response_data = await self._call_upstream(processed_request, target_model_id, target_base_url, target_api_key, timeout_ms, stream_timeout_ms, trace_id, retry_count, call_start_time, add_trace_event, protocol=target_protocol)
                     
                     # Record Success for Adaptive Routing
                     self._record_success(model_id_for_stats)
@@ -1834,22 +2061,7 @@ class RouterEngine:
                     self._record_response_time(model_id_for_stats, duration)
                     
                     # Extract usage if available
-                    token_source = "upstream"
-                    if "usage" in response_data:
-                         usage = response_data["usage"]
-                         prompt_tokens = usage.get("prompt_tokens", 0)
-                         completion_tokens = usage.get("completion_tokens", 0)
-                    else:
-                         token_source = "local"
-                         prompt_tokens = 0
-                         completion_tokens = 0
-                         if "usage" not in response_data:
-                             req_messages = request.messages
-                             prompt_tokens = self._count_messages_tokens(req_messages, model_name)
-                             completion_content = ""
-                             if "choices" in response_data and response_data["choices"]:
-                                 completion_content = response_data["choices"][0]["message"].get("content", "")
-                             completion_tokens = self._count_tokens(completion_content, model_name)
+                    prompt_tokens, completion_tokens, token_source = self._extract_usage(response_data, request.messages, model_name, count_tokens_locally)
 
                     # 🎉 成功响应的美观日志
                     logger.info("")
@@ -1865,13 +2077,12 @@ class RouterEngine:
                     logger.info("╚" + "═" * 58 + "╝")
                     logger.info("")
 
-                    # Log success (Async via BackgroundTasks)
-                    background_tasks.add_task(
-                        self._log_request,
+                    # Log success (queued for the batch writer)
+                    await self._log_request(
                         level, display_model_name, duration, "success", 
-                        self._extract_text_from_content(log_messages[-1].get("content")) if log_messages else user_prompt, 
-                        json.dumps({**request.model_dump(), "messages": log_messages}), 
-                        json.dumps(response_data), 
+                        self._prompt_preview(log_messages[-1].get("content")) if log_messages else user_prompt, 
+                        {**request_dict, "messages": log_messages}, 
+                        response_data, 
                         trace_events, None, retry_count, prompt_tokens, completion_tokens, token_source
                     )
                     
@@ -1883,53 +2094,7 @@ class RouterEngine:
                     fail_duration = (fail_time - call_start_time) * 1000
                     
                     # Extract Reason from Exception
-                    error_msg = str(e)
-                    reason = "Unknown Error"
-                    penalty = 1.0 # Default penalty
-                    cooldown = 0 # Default cooldown (seconds)
-                    
-                    if "TTFT Timeout" in error_msg:
-                        reason = "超首token限制时长"
-                        penalty = 0.5 # Timeout is often transient
-                    elif "Total Timeout" in error_msg:
-                        reason = "超总限制时长"
-                        penalty = 0.5
-                    elif "Status Code Error" in error_msg:
-                         # Extract code?
-                         reason = "触发错误状态码"
-                         if ":" in error_msg:
-                             code_part = error_msg.split(':')[1].strip()
-                             reason += f": {code_part}"
-                             # Adjust penalty based on code
-                             if "429" in code_part:
-                                 penalty = 10.0 # Rate limit - Heavy penalty to avoid selection
-                                 cooldown = 60 # Cooldown for 60s
-                             elif "401" in code_part or "403" in code_part:
-                                 penalty = 50.0 # Auth error - Very heavy penalty
-                                 cooldown = 300 # Cooldown 5 mins
-                             elif code_part.strip().startswith("5"):
-                                 penalty = 1.0 # Server error
-                    elif "Error Keyword Match" in error_msg:
-                         reason = "错误关键词"
-                         if ":" in error_msg:
-                             reason += f": {error_msg.split(':')[1].strip()}"
-                         penalty = 10.0
-                         cooldown = 60 # Treat custom errors as serious
-                    elif "Empty Response" in error_msg:
-                        reason = "空返回"
-                        penalty = 1.0
-                    elif "Connect Timeout" in error_msg:
-                        reason = "连接超时"
-                        penalty = 0.5
-                    elif "Upstream Error" in error_msg:
-                         reason = "上游错误"
-                         if ":" in error_msg:
-                             # Keep more context for tooltip
-                             reason += f": {error_msg.split(':', 1)[1].strip()}"
-                         penalty = 1.0
-                    else:
-                        reason = error_msg # No truncation
-                        penalty = 1.0
+                    kind, reason, penalty, cooldown, status_code = _classify_exception(e)
 
                     # ❌ 模型失败的美观日志
                     logger.info("")
@@ -1942,8 +2107,7 @@ class RouterEngine:
                         logger.info(f"  🕒  冷却: {cooldown}秒")
                     logger.info("  " + "─" * 56)
                     
-                    trace_logger.log(trace_id, "MODEL_FAIL", fail_time, fail_duration, "fail", retry_count, details=f"原因: {reason} | 模型: {display_model_name}")
-                    add_trace_event("MODEL_FAIL", fail_time, fail_duration, "fail", retry_count, model=display_model_name, reason=reason)
+                    trace_both("MODEL_FAIL", fail_time, fail_duration, "fail", retry_count, details=f"原因: {reason} | 模型: {display_model_name}", model=display_model_name, reason=reason)
                     
                     # Record Failure for Adaptive Routing with calculated penalty and cooldown
                     self._record_failure(model_id_for_stats, penalty=penalty, cooldown_seconds=cooldown)
@@ -1955,12 +2119,9 @@ class RouterEngine:
                     attempt_errors.append(detailed_error)
 
                     # Strategy: 
-                    # 1. Hard Failures (Auth, Client Error) -> Exclude for entire request
-                    if "401" in error_msg or "403" in error_msg or "404" in error_msg:
-                         excluded_models.add(model_id_for_stats)
-                    # 2. Rate Limit (429) -> Exclude for entire request to avoid spamming
-                    elif "429" in error_msg:
-                         excluded_models.add(model_id_for_stats)
+                    # Hard Failures (Auth, Client Error) and Rate Limit (429) -> Exclude for entire request
+                    if status_code in _HARD_FAIL_CODES:
+                         excluded_mask |= model_bit
 
                     last_error = e
                     last_stack_trace = traceback.format_exc()
@@ -1970,7 +2131,8 @@ class RouterEngine:
                     continue
                 
         # All failed
-        duration = (time.time() - start_time) * 1000
+        fail_time = time.time()
+        duration = (fail_time - start_time) * 1000
         
         # 💥 所有模型失败的美观日志
         logger.info("")
@@ -1981,12 +2143,11 @@ class RouterEngine:
         logger.info(f"⏱️  总耗时: {duration:.1f}ms")
         logger.info("")
         
-        trace_logger.log(trace_id, "ALL_FAILED", time.time(), duration, "fail", retry_count, details=f"所有 {len(models)} 个模型尝试均失败")
-        add_trace_event("ALL_FAILED", time.time(), duration, "fail", retry_count)
+        trace_both("ALL_FAILED", fail_time, duration, "fail", retry_count, details=f"所有 {len(models)} 个模型尝试均失败")
         
-        # Await logging directly to ensure it's recorded before raising exception
+        # Queue the failure log before raising (flushed by the batch writer)
         await self._log_request(
-            level, "all", duration, "error", user_prompt, request.model_dump_json(), str(last_error), trace_events, last_stack_trace, retry_count
+            level, "all", duration, "error", user_prompt, request_dict, str(last_error), trace_events, last_stack_trace, retry_count
         )
         
         trace_logger.log_separator("=")
@@ -2004,79 +2165,38 @@ class RouterEngine:
         
         raise HTTPException(status_code=502, detail=f"All models failed after {retry_count} retries. Last error: {str(last_error)}")
 
-    async def _call_upstream(self, request: ChatCompletionRequest, model_id: str, base_url: str, api_key: str, timeout_ms: int, stream_timeout_ms: int, trace_id: str, retry_count: int, req_start_time: float, trace_callback=None, protocol: str = "openai", verify_ssl: bool = True) -> Dict[str, Any]:
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # Prepare payload
-        payload = request.model_dump(exclude_none=True)
-        payload["model"] = model_id
-        
-        # Check Protocol for Stream
-        if protocol == "v1-messages" or protocol == "v1-response":
-            payload["stream"] = False
-        else:
-            payload["stream"] = True # Force stream for aggregation
+    async def _call_upstream(self, request_dict: Dict[str, Any], model_id: str, base_url: str, api_key: str, timeout_ms: int, stream_timeout_ms: int, trace_id: str, retry_count: int, req_start_time: float, trace_callback=None, protocol: str = "openai") -> Dict[str, Any]:
+        headers = _auth_headers(api_key)
         
         config = config_manager.get_config()
         
         # --- Parameter Merge Logic ---
         # Priority: Request > Model Specific > Global Default
         
-        # 1. Global Defaults
-        for key, value in config.params.global_params.items():
-            if key not in payload:
-                payload[key] = value
-                
-        # 2. Model Specific Defaults
-        if model_id in config.params.model_params:
-            for key, value in config.params.model_params[model_id].items():
-                if key not in payload or request.model_dump().get(key) is None: 
-                     pass
-
-        # Re-construct payload to ensure correct precedence
-        final_payload = {}
-        
-        # Base: Global Defaults
-        final_payload.update(config.params.global_params)
-        
-        # Override: Model Specific Defaults
-        if model_id in config.params.model_params:
-            final_payload.update(config.params.model_params[model_id])
+        # Base: Global + Model Specific Defaults (pre-merged at config load)
+        payload = config_manager.merged_defaults.get(model_id, config_manager.global_defaults).copy()
             
-        # Override: Request Params (only if not None)
-        request_dict = request.model_dump(exclude_none=True)
-        final_payload.update(request_dict)
+        # Override: Request Params (None values already excluded by the caller)
+        payload.update(request_dict)
         
         # Ensure critical fields
-        final_payload["model"] = model_id
+        payload["model"] = model_id
         if protocol == "v1-messages" or protocol == "v1-response":
-            final_payload["stream"] = False
+            payload["stream"] = False
         else:
-            final_payload["stream"] = True
+            payload["stream"] = True
             # Enable usage reporting for streaming
-            final_payload["stream_options"] = {"include_usage": True}
-        
-        payload = final_payload
+            payload["stream_options"] = {"include_usage": True}
         # -----------------------------
         
-        timeout_sec = timeout_ms / 1000.0
-        # Use user-configured timeout for the stream continuity
-        stream_timeout = stream_timeout_ms / 1000.0
-        
         # Configure granular timeouts
         # connect: fail fast if upstream is unreachable (capped at TTFT timeout)
         # read: allow long generation (capped at Stream timeout)
-        timeout_config = httpx.Timeout(
-            connect=timeout_sec,
-            read=stream_timeout,
-            write=stream_timeout,
-            pool=stream_timeout
-        )
+        timeout_config = _mk_timeout(timeout_ms, stream_timeout_ms)
+        timeout_sec = timeout_config.connect
         
-        if self._client is None: await self.startup()
+        if self._upstream_client is None: await self.startup()
+        client_to_use = self._upstream_client
 
         # Handle v1-response Protocol (No Stream, /v1/responses endpoint)
         if protocol == "v1-response":
@@ -2178,18 +2298,9 @@ class RouterEngine:
              payload = v1_response_payload
              
              try:
-                # FORCE DISABLE SSL VERIFICATION as requested by user
-                verify_ssl = False
-                
-                temp_client = httpx.AsyncClient(verify=False, timeout=timeout_config)
-                client_to_use = temp_client
-                    
-                try:
-                    logger.info(f"Upstream Request (v1-response): {url} (SSL Disabled)")
-                    response = await client_to_use.post(url, json=payload, headers=headers, timeout=timeout_config)
-                finally:
-                    if temp_client:
-                        await temp_client.aclose()
+                # FORCE DISABLE SSL VERIFICATION as requested by user (shared verify=False client)
+                logger.info(f"Upstream Request (v1-response): {url} (SSL Disabled)")
+                response = await client_to_use.post(url, json=payload, headers=headers, timeout=timeout_config)
                  
                 ttft_time = time.time()
                 duration_ttft = (ttft_time - req_start_time) * 1000
@@ -2211,15 +2322,19 @@ class RouterEngine:
                                 break
                     
                     if should_retry:
-                        raise Exception(f"Upstream Error (Retryable): {response.status_code} - {error_str}")
+                        raise UpstreamError(f"Upstream Error (Retryable): {response.status_code} - {error_str}", "upstream", response.status_code, f"{response.status_code} - {error_str}")
                     else:
-                        raise Exception(f"Upstream Error: {response.status_code} - {error_str}")
+                        raise UpstreamError(f"Upstream Error: {response.status_code} - {error_str}", "upstream", response.status_code, f"{response.status_code} - {error_str}")
 
-                response_data = response.json()
+                # Parse the raw body bytes directly (no intermediate str decode)
+                response_data = _json_loads(response.content)
+                # One clock read for the response timestamp, created and the log duration
+                full_resp_time = time.time()
+                created_ts = int(full_resp_time)
                 
                 # 转换 v1/responses 响应格式为 OpenAI chat.completions 兼容格式
                 if "choices" not in response_data:
-                    content_text = ""
+                    text_parts = []
                     tool_calls = []
                     
                     # v1/responses 格式分析
@@ -2237,17 +2352,17 @@ class RouterEngine:
                                         if isinstance(msg_content, list):
                                             for c in msg_content:
                                                 if isinstance(c, dict) and c.get("type") == "output_text":
-                                                    content_text += c.get("text", "")
+                                                    text_parts.append(c.get("text", ""))
                                         elif isinstance(msg_content, str):
-                                            content_text += msg_content
+                                            text_parts.append(msg_content)
                                     
                                     elif item_type == "function_call":
                                         # 函数调用类型
                                         args = item.get("arguments")
                                         if isinstance(args, dict):
-                                            args = json.dumps(args)
+                                            args = _json_dumps(args)
                                         tool_call = {
-                                            "id": item.get("id", f"call_{int(time.time())}"),
+                                            "id": item.get("id", f"call_{created_ts}"),
                                             "type": "function",
                                             "function": {
                                                 "name": item.get("name", ""),
@@ -2258,10 +2373,11 @@ class RouterEngine:
                                     
                                     elif item_type == "output_text":
                                         # 直接输出文本（旧格式兼容）
-                                        content_text += item.get("text", "")
+                                        text_parts.append(item.get("text", ""))
                                         
                         elif isinstance(output, str):
-                            content_text = output
+                            text_parts.append(output)
+                    content_text = "".join(text_parts)
                     
                     # 构造 Message 对象
                     message_obj = {
@@ -2271,40 +2387,34 @@ class RouterEngine:
                     if tool_calls:
                         message_obj["tool_calls"] = tool_calls
                     
-                    # 获取 usage 信息
-                    prompt_tokens = self._count_messages_tokens(request.messages, model_id)
-                    completion_tokens = self._count_tokens(content_text, model_id)
-                    
-                    if "usage" in response_data:
-                        usage = response_data["usage"]
-                        if "input_tokens" in usage:
-                            prompt_tokens = usage["input_tokens"]
-                        if "output_tokens" in usage:
-                            completion_tokens = usage["output_tokens"]
+                    # 获取 usage 信息 (local counts only for fields upstream omitted)
+                    usage = response_data.get("usage") or {}
+                    local_prompt_tokens = None
+                    if "input_tokens" in usage:
+                        prompt_tokens = usage["input_tokens"]
+                    else:
+                        # Tokenizer work runs off the event loop
+                        prompt_tokens = local_prompt_tokens = await asyncio.to_thread(self._count_messages_tokens, request_dict["messages"], model_id)
+                    if "output_tokens" in usage:
+                        completion_tokens = usage["output_tokens"]
+                    else:
+                        completion_tokens = await asyncio.to_thread(self._count_tokens, content_text, model_id)
                     
                     # 构造 OpenAI 格式响应
-                    mapped_response = {
-                        "id": response_data.get("id", f"chatcmpl-{int(time.time())}"),
-                        "object": "chat.completion",
-                        "created": int(time.time()),
-                        "model": response_data.get("model", model_id),
-                        "choices": [
-                            {
-                                "index": 0,
-                                "message": message_obj,
-                                "finish_reason": "tool_calls" if tool_calls else (response_data.get("status", "stop") or "stop")
-                            }
-                        ],
-                        "usage": {
+                    response_data = _chat_completion(
+                        response_data.get("id", f"chatcmpl-{created_ts}"),
+                        created_ts,
+                        response_data.get("model", model_id),
+                        message_obj,
+                        "tool_calls" if tool_calls else (response_data.get("status", "stop") or "stop"),
+                        {
                             "prompt_tokens": prompt_tokens,
                             "completion_tokens": completion_tokens,
                             "total_tokens": prompt_tokens + completion_tokens
-                        }
-                    }
-                        
-                    response_data = mapped_response
+                        },
+                        local_prompt_tokens
+                    )
                 
-                full_resp_time = time.time()
                 duration_since_ttft = (full_resp_time - ttft_time)*1000
                 
                 usage = response_data.get("usage", {})
@@ -2318,9 +2428,9 @@ class RouterEngine:
                 return response_data
                 
              except httpx.ReadTimeout:
-                raise Exception("Total Timeout (Read): Read timeout from upstream")
+                raise UpstreamError("Total Timeout (Read): Read timeout from upstream", "total")
              except httpx.ConnectTimeout:
-                raise Exception("Connect Timeout: Connect timeout to upstream")
+                raise UpstreamError("Connect Timeout: Connect timeout to upstream", "connect")
              except Exception:
                  raise
 
@@ -2334,15 +2444,10 @@ class RouterEngine:
              
              # Also convert tools if present
              if "tools" in payload:
-                 anthropic_tools = []
-                 for t in payload["tools"]:
-                     if t.get("type") == "function":
-                         func = t.get("function", {})
-                         anthropic_tools.append({
-                             "name": func.get("name"),
-                             "description": func.get("description"),
-                             "input_schema": func.get("parameters")
-                         })
+                 anthropic_tools = [
+                     _anthropic_tool(t.get("function") or {})
+                     for t in payload["tools"] if t.get("type") == "function"
+                 ]
                  if anthropic_tools:
                      payload["tools"] = anthropic_tools
                      # Remove tool_choice if set to auto (default) or handle mapping
@@ -2361,20 +2466,9 @@ class RouterEngine:
              url = f"{base}/messages"
              
              try:
-                 # Handle SSL verification logic manually since httpx.post doesn't support 'verify' arg
-                
-                # FORCE DISABLE SSL VERIFICATION as requested by user (v1-messages)
-                verify_ssl = False
-                
-                temp_client = httpx.AsyncClient(verify=False, timeout=timeout_config)
-                client_to_use = temp_client
-                    
-                try:
-                    logger.info(f"Upstream Request (v1-messages): {url} (SSL Disabled)")
-                    response = await client_to_use.post(url, json=payload, headers=headers, timeout=timeout_config)
-                finally:
-                    if temp_client:
-                        await temp_client.aclose()
+                # FORCE DISABLE SSL VERIFICATION as requested by user (v1-messages, shared verify=False client)
+                logger.info(f"Upstream Request (v1-messages): {url} (SSL Disabled)")
+                response = await client_to_use.post(url, json=payload, headers=headers, timeout=timeout_config)
                  
                 ttft_time = time.time()
                 duration_ttft = (ttft_time - req_start_time) * 1000
@@ -2396,80 +2490,80 @@ class RouterEngine:
                                 break
                     
                     if should_retry:
-                        raise Exception(f"Upstream Error (Retryable): {response.status_code} - {error_str}")
+                        raise UpstreamError(f"Upstream Error (Retryable): {response.status_code} - {error_str}", "upstream", response.status_code, f"{response.status_code} - {error_str}")
                     else:
-                        raise Exception(f"Upstream Error: {response.status_code} - {error_str}")
+                        raise UpstreamError(f"Upstream Error: {response.status_code} - {error_str}", "upstream", response.status_code, f"{response.status_code} - {error_str}")
 
-                response_data = response.json()
+                # Parse the raw body bytes directly (no intermediate str decode)
+                response_data = _json_loads(response.content)
+                full_resp_time = time.time()
                 
                 # 转换 v1/messages 响应格式为 OpenAI 兼容格式
                 if "choices" not in response_data and "content" in response_data:
                     # 提取 content 和 tool_calls
                     content_raw = response_data.get("content")
-                    content_text = ""
+                    text_parts = []
                     tool_calls = []
                     
                     if isinstance(content_raw, str):
-                        content_text = content_raw
+                        text_parts.append(content_raw)
                     elif isinstance(content_raw, list):
+                        # Single pass over content blocks
                         for item in content_raw:
                             if isinstance(item, dict):
                                 item_type = item.get("type")
                                 if item_type == "text":
-                                    content_text += item.get("text", "")
+                                    text_parts.append(item.get("text", ""))
                                 elif item_type == "tool_use":
                                     # 转换 Anthropic tool_use 到 OpenAI tool_call
                                     # Anthropic: {"type": "tool_use", "id": "...", "name": "...", "input": {...}}
                                     # OpenAI: {"id": "...", "type": "function", "function": {"name": "...", "arguments": "..."}}
-                                    tool_call = {
+                                    tool_calls.append({
                                         "id": item.get("id"),
                                         "type": "function",
                                         "function": {
                                             "name": item.get("name"),
                                             # OpenAI expect arguments as a JSON string, Anthropic provides a dict
-                                            "arguments": json.dumps(item.get("input", {}))
+                                            "arguments": _json_dumps(item.get("input", {}))
                                         }
-                                    }
-                                    tool_calls.append(tool_call)
+                                    })
+                    content_text = "".join(text_parts)
+                    
+                    # 确保 usage 中的 key 是 OpenAI 兼容的 (Anthropic 使用 input_tokens/output_tokens)
+                    raw_usage = response_data.get("usage")
+                    local_prompt_tokens = None
+                    if raw_usage is not None:
+                        usage_obj = {_OAI_USAGE_MAP.get(k, k): v for k, v in raw_usage.items()}
+                    else:
+                        # Only count locally when upstream omitted usage (off the event loop)
+                        local_prompt_tokens, local_completion_tokens = await asyncio.to_thread(self._count_usage_locally, request_dict["messages"], content_text, model_id)
+                        usage_obj = {
+                            "prompt_tokens": local_prompt_tokens,
+                            "completion_tokens": local_completion_tokens
+                        }
+                    if "total_tokens" not in usage_obj:
+                        usage_obj["total_tokens"] = usage_obj.get("prompt_tokens", 0) + usage_obj.get("completion_tokens", 0)
                     
                     # 构造 Message 对象
                     message_obj = {
                         "role": response_data.get("role", "assistant"),
-                        "content": content_text if content_text else None
+                        "content": content_text or None
                     }
                     if tool_calls:
                         message_obj["tool_calls"] = tool_calls
                     
                     # 构造 OpenAI 格式响应
-                    mapped_response = {
-                        "id": response_data.get("id", f"msg_{int(time.time())}"),
-                        "object": "chat.completion",
-                        "created": int(time.time()),
-                        "model": response_data.get("model", model_id),
-                        "choices": [
-                            {
-                                "index": 0,
-                                "message": message_obj,
-                                "finish_reason": response_data.get("stop_reason", "stop")
-                            }
-                        ],
-                        "usage": response_data.get("usage", {
-                            "prompt_tokens": self._count_messages_tokens(request.messages, model_id),
-                            "completion_tokens": self._count_tokens(content_text, model_id),
-                            "total_tokens": 0
-                        })
-                    }
-                    # 确保 usage 中的 key 是 OpenAI 兼容的 (Anthropic 使用 input_tokens/output_tokens)
-                    if "input_tokens" in mapped_response["usage"]:
-                        mapped_response["usage"]["prompt_tokens"] = mapped_response["usage"].pop("input_tokens")
-                    if "output_tokens" in mapped_response["usage"]:
-                        mapped_response["usage"]["completion_tokens"] = mapped_response["usage"].pop("output_tokens")
-                    if "total_tokens" not in mapped_response["usage"]:
-                        mapped_response["usage"]["total_tokens"] = mapped_response["usage"].get("prompt_tokens", 0) + mapped_response["usage"].get("completion_tokens", 0)
-                        
-                    response_data = mapped_response
+                    created_ts = int(full_resp_time)
+                    response_data = _chat_completion(
+                        response_data.get("id", f"msg_{created_ts}"),
+                        created_ts,
+                        response_data.get("model", model_id),
+                        message_obj,
+                        response_data.get("stop_reason", "stop"),
+                        usage_obj,
+                        local_prompt_tokens
+                    )
                 
-                full_resp_time = time.time()
                 duration_since_ttft = (full_resp_time - ttft_time)*1000
                 
                 usage = response_data.get("usage", {})
@@ -2483,328 +2577,365 @@ class RouterEngine:
                 return response_data
                 
              except httpx.ReadTimeout:
-                raise Exception("Total Timeout (Read): Read timeout from upstream")
+                raise UpstreamError("Total Timeout (Read): Read timeout from upstream", "total")
              except httpx.ConnectTimeout:
-                raise Exception("Connect Timeout: Connect timeout to upstream")
+                raise UpstreamError("Connect Timeout: Connect timeout to upstream", "connect")
              except Exception:
                  raise
 
         try:
             # Manually manage the stream context to decouple TTFT timeout from Body timeout
-            # Use global client with specific request timeout
+            # Use the shared upstream client (SSL verification force-disabled) with specific request timeout
+            base_url_stream = base_url.rstrip('/')
+            # Prevent double path appending
+            if base_url_stream.endswith("/chat/completions"):
+                url_stream = base_url_stream
+            elif base_url_stream.endswith("/"):
+                url_stream = f"{base_url_stream}chat/completions"
+            else:
+                url_stream = f"{base_url_stream}/chat/completions"
+                
+            logger.info(f"Upstream Request (Stream): {url_stream} (SSL Disabled)")
             
-            # Determine which client to use based on verify_ssl requirement
-            temp_client = None
-            client_to_use = self._client
+            # Do NOT pass verify=... to stream(), as it's not supported in all versions/modes
+            ctx = client_to_use.stream("POST", url_stream, json=payload, headers=headers, timeout=timeout_config)
             
-            # FORCE DISABLE SSL VERIFICATION as requested by user (stream)
-            verify_ssl = False
+            try:
+                # Enforce TTFT (Wait for Headers)
+                # Note: httpx connect timeout will trigger first/simultaneously if connection fails
+                response = await asyncio.wait_for(ctx.__aenter__(), timeout=timeout_sec)
+            except asyncio.TimeoutError:
+                raise UpstreamError(f"TTFT Timeout (Headers) > {timeout_sec}s", "ttft")
+            except Exception:
+                raise
             
-            # Create a temporary client with verify=False
-            # Inherit global limits if possible, but for temp usage default is fine
-            temp_client = httpx.AsyncClient(verify=False, timeout=timeout_config)
-            client_to_use = temp_client
+            # 3. Log: First Token (Headers Received)
+            ttft_time = time.time()
+            # Duration from "Request Received" (or "Retry Start"?) Prompt says: "Retry/FirstCall -> First Token"
+            # So we need time of THIS call start? Yes, req_start_time passed in is actually call_start_time now.
+            duration_ttft = (ttft_time - req_start_time) * 1000
             
-            try:
-                base_url_stream = base_url.rstrip('/')
-                # Prevent double path appending
-                if base_url_stream.endswith("/chat/completions"):
-                    url_stream = base_url_stream
-                elif base_url_stream.endswith("/"):
-                    url_stream = f"{base_url_stream}chat/completions"
-                else:
-                    url_stream = f"{base_url_stream}/chat/completions"
-                    
-                logger.info(f"Upstream Request (Stream): {url_stream} (SSL Disabled)")
-                
-                # Do NOT pass verify=... to stream(), as it's not supported in all versions/modes
-                ctx = client_to_use.stream("POST", url_stream, json=payload, headers=headers, timeout=timeout_config)
-                
-                try:
-                    # Enforce TTFT (Wait for Headers)
-                    # Note: httpx connect timeout will trigger first/simultaneously if connection fails
-                    response = await asyncio.wait_for(ctx.__aenter__(), timeout=timeout_sec)
-                except asyncio.TimeoutError:
-                    raise Exception(f"TTFT Timeout (Headers) > {timeout_sec}s")
-                except Exception:
-                    raise
-                
-                # 3. Log: First Token (Headers Received)
-                ttft_time = time.time()
-                # Duration from "Request Received" (or "Retry Start"?) Prompt says: "Retry/FirstCall -> First Token"
-                # So we need time of THIS call start? Yes, req_start_time passed in is actually call_start_time now.
-                duration_ttft = (ttft_time - req_start_time) * 1000
-                
-                trace_logger.log(trace_id, "FIRST_TOKEN", ttft_time, duration_ttft, "success", retry_count, details=f"首字响应 | 模型: {model_id}")
-                if trace_callback:
-                    trace_callback("FIRST_TOKEN", ttft_time, duration_ttft, "success", retry_count) 
+            trace_logger.log(trace_id, "FIRST_TOKEN", ttft_time, duration_ttft, "success", retry_count, details=f"首字响应 | 模型: {model_id}")
+            if trace_callback:
+                trace_callback("FIRST_TOKEN", ttft_time, duration_ttft, "success", retry_count) 
 
-                try:
-                        # 1. Check Status Code Failover
-                        if response.status_code != 200:
-                            try:
-                                error_text = await asyncio.wait_for(response.aread(), timeout=10.0)
-                            except asyncio.TimeoutError:
-                                error_text = b"Error body read timed out"
-                                
-                            error_str = error_text.decode(errors='replace')
-                            
-                            should_retry = False
-                            if response.status_code in config.retries.conditions.status_codes:
-                                should_retry = True
-                            
-                            # 2. Check Error Keyword Failover
-                            keyword_match = None
-                            if not should_retry:
-                                lower_error = error_str.lower()
-                                for k in config.retries.conditions.error_keywords:
-                                    if k in lower_error:
-                                        should_retry = True
-                                        keyword_match = k
-                                        break
+            try:
+                    # 1. Check Status Code Failover
+                    if response.status_code != 200:
+                        try:
+                            error_text = await asyncio.wait_for(response.aread(), timeout=10.0)
+                        except asyncio.TimeoutError:
+                            error_text = b"Error body read timed out"
                             
-                            if should_retry:
-                                if keyword_match:
-                                    raise Exception(f"Error Keyword Match: {keyword_match} in {error_str}")
-                                else:
-                                    raise Exception(f"Status Code Error: {response.status_code} - {error_str}")
-                            else:
-                                raise Exception(f"Upstream Error: {response.status_code} - {error_str}")
-
-                        # Aggregate Stream
-                        aggregated_content = ""
-                        aggregated_tool_calls = {} # index -> tool_call
-                        finish_reason = None
-                        role = "assistant"
-                        usage_info = None # Capture usage from stream options if available
-                        prompt_tokens = 0
-                        completion_tokens = 0
+                        error_str = error_text.decode(errors='replace')
+                        
+                        should_retry = False
+                        if response.status_code in config.retries.conditions.status_codes:
+                            should_retry = True
                         
-                        # Pre-calculate prompt tokens locally just in case
-                        # Use full messages list for accuracy, fallback to empty list
-                        req_messages = payload.get("messages", [])
-                        local_prompt_tokens = self._count_messages_tokens(req_messages, model_id)
+                        # 2. Check Error Keyword Failover
+                        keyword_match = None
+                        if not should_retry:
+                            lower_error = error_str.lower()
+                            for k in config.retries.conditions.error_keywords:
+                                if k in lower_error:
+                                    should_retry = True
+                                    keyword_match = k
+                                    break
                         
-                        # Fix for Kimi/Moonshot & httpx compatibility issues:
-                        # Manually handle buffer and decoding instead of relying on aiter_lines()
-                        buffer = ""
-                        async for chunk in response.aiter_bytes():
+                        if should_retry:
+                            if keyword_match:
+                                raise UpstreamError(f"Error Keyword Match: {keyword_match} in {error_str}", "keyword", response.status_code, keyword_match, keyword=keyword_match.lower())
+                            else:
+                                raise UpstreamError(f"Status Code Error: {response.status_code} - {error_str}", "status", response.status_code, str(response.status_code))
+                        else:
+                            raise UpstreamError(f"Upstream Error: {response.status_code} - {error_str}", "upstream", response.status_code, f"{response.status_code} - {error_str}")
+
+                    # Aggregate Stream
+                    content_parts = [] # Joined once after the stream ends
+                    aggregated_tool_calls = [] # slot = tool-call index -> {"id", "type", "name_parts", "args_parts"} or None
+                    finish_reason = None
+                    role = "assistant"
+                    usage_info = None # Capture usage from stream options if available
+                    prompt_tokens = 0
+                    completion_tokens = 0
+                    
+                    # Fix for Kimi/Moonshot & httpx compatibility issues:
+                    # Manually handle buffer and decoding instead of relying on aiter_lines()
+                    # Hot loop: bind the global parser and bound methods to locals once
+                    loads = _json_loads
+                    append_content = content_parts.append
+                    async for frames in self._aiter_sse_frames(response):
+                        for data_str in frames:
                             try:
-                                text_chunk = chunk.decode("utf-8")
-                            except UnicodeDecodeError:
-                                # Handle potential split multi-byte characters if needed, 
-                                # but for now assume clean chunks or use 'ignore/replace' if critical.
-                                # For robustness, we could use an incremental decoder, but let's try simple first.
-                                text_chunk = chunk.decode("utf-8", errors="replace")
+                                chunk_json = loads(data_str)
+                                # Always check for usage field first, regardless of choices
+                                chunk_usage = chunk_json.get("usage")
+                                if chunk_usage is not None:
+                                    usage_info = chunk_usage
+
+                                choices = chunk_json.get("choices")
+                                if not choices:
+                                    continue
                                 
-                            buffer += text_chunk
+                                choice = choices[0]
+                                delta = choice.get("delta") or {}
+                                finish_reason = choice.get("finish_reason", finish_reason)
                             
-                            while "\n" in buffer:
-                                line, buffer = buffer.split("\n", 1)
-                                line = line.strip()
+                                # Aggregate Content
+                                content = delta.get("content")
+                                if content is not None:
+                                    append_content(content)
                                 
-                                if not line:
-                                    continue
+                                # Aggregate Tool Calls
+                                delta_tool_calls = delta.get("tool_calls")
+                                if delta_tool_calls:
+                                    for tc in delta_tool_calls:
+                                        # Indices are small and increasing; providers that omit them stream a single call
+                                        index = tc.get("index") or 0
+                                        tc_id = tc.get("id")
+                                        while len(aggregated_tool_calls) <= index:
+                                            aggregated_tool_calls.append(None)
+                                        slot = aggregated_tool_calls[index]
+                                        if slot is None:
+                                            slot = aggregated_tool_calls[index] = {
+                                                "id": tc_id or "",
+                                                "type": tc.get("type", "function"),
+                                                "name_parts": [],
+                                                "args_parts": []
+                                            }
+                                        elif tc_id:
+                                            slot["id"] = tc_id
                                     
-                                if line.startswith("data: "):
-                                    data_str = line[6:]
-                                    if data_str == "[DONE]":
-                                        continue # Don't break yet, process rest of buffer
-                                    try:
-                                        chunk_json = json.loads(data_str)
-                                        # Always check for usage field first, regardless of choices
-                                        if "usage" in chunk_json:
-                                            usage_info = chunk_json["usage"]
-
-                                        choices = chunk_json.get("choices", [])
-                                        if not choices:
-                                            continue
-                                            
-                                        delta = choices[0].get("delta", {})
-                                        finish_reason = choices[0].get("finish_reason", finish_reason)
-                                        
-                                        # Aggregate Content
-                                        if "content" in delta and delta["content"] is not None:
-                                            aggregated_content += delta["content"]
-                                            
-                                        # Aggregate Tool Calls
-                                        if "tool_calls" in delta and delta["tool_calls"]:
-                                            for tc in delta["tool_calls"]:
-                                                index = tc.get("index")
-                                                if index not in aggregated_tool_calls:
-                                                    aggregated_tool_calls[index] = {
-                                                        "id": tc.get("id", ""),
-                                                        "type": tc.get("type", "function"),
-                                                        "function": {"name": "", "arguments": ""}
-                                                    }
-                                                
-                                                if tc.get("id"):
-                                                    aggregated_tool_calls[index]["id"] = tc["id"]
-                                                
-                                                if "function" in tc:
-                                                    if tc["function"].get("name"):
-                                                        aggregated_tool_calls[index]["function"]["name"] += tc["function"]["name"]
-                                                    if tc["function"].get("arguments"):
-                                                        aggregated_tool_calls[index]["function"]["arguments"] += tc["function"]["arguments"]
-
-                                    except json.JSONDecodeError:
-                                        continue
-
-                        # Check for empty content (Retry trigger)
-                        if not aggregated_content and not aggregated_tool_calls:
-                            if config.retries.conditions.retry_on_empty:
-                                raise Exception("Empty Response: Upstream returned empty content and no tool calls")
-                            else:
-                                # If retry disabled, just return empty response (or handle gracefully)
-                                pass # Continue to construct response
+                                        fn = tc.get("function")
+                                        if fn:
+                                            name = fn.get("name")
+                                            if name:
+                                                slot["name_parts"].append(name)
+                                            args = fn.get("arguments")
+                                            if args:
+                                                slot["args_parts"].append(args)
+
+                            except json.JSONDecodeError:
+                                continue
+
+                    aggregated_content = "".join(content_parts)
+                    
+                    # Check for empty content (Retry trigger)
+                    if not aggregated_content and not aggregated_tool_calls:
+                        if config.retries.conditions.retry_on_empty:
+                            raise UpstreamError("Empty Response: Upstream returned empty content and no tool calls", "empty")
+                        else:
+                            # If retry disabled, just return empty response (or handle gracefully)
+                            pass # Continue to construct response
 
-                        # Construct final response
-                        message = {
-                            "role": role,
-                            "content": aggregated_content if aggregated_content else None
-                        }
-                        
-                        if aggregated_tool_calls:
-                            tool_calls_list = []
-                            for i in sorted(aggregated_tool_calls.keys()):
-                                tool_calls_list.append(aggregated_tool_calls[i])
-                            message["tool_calls"] = tool_calls_list
-                        
-                        # Calculate completion tokens locally if needed
-                        local_completion_tokens = 0
-                        if not usage_info:
-                            local_completion_tokens = self._count_tokens(aggregated_content, model_id)
-
-                        final_response = {
-                            "id": f"chatcmpl-{int(time.time())}",
-                            "object": "chat.completion",
-                            "created": int(time.time()),
-                            "model": model_id,
-                            "choices": [
-                                {
-                                    "index": 0,
-                                    "message": message,
-                                    "finish_reason": finish_reason or "stop"
-                                }
-                            ],
-                            "usage": usage_info or {
-                                "prompt_tokens": local_prompt_tokens,
-                                "completion_tokens": local_completion_tokens,
-                                "total_tokens": local_prompt_tokens + local_completion_tokens
+                    # Construct final response
+                    message = {
+                        "role": role,
+                        "content": aggregated_content if aggregated_content else None
+                    }
+                    
+                    if aggregated_tool_calls:
+                        message["tool_calls"] = [
+                            {
+                                "id": tc["id"],
+                                "type": tc["type"],
+                                "function": {"name": "".join(tc["name_parts"]), "arguments": "".join(tc["args_parts"])}
                             }
+                            for tc in aggregated_tool_calls if tc is not None
+                        ]
+                    
+                    # Count locally only when the stream carried no usage (off the event loop,
+                    # so other streams keep flowing while the tokenizer runs)
+                    local_prompt_tokens = None
+                    if not usage_info:
+                        local_prompt_tokens, local_completion_tokens = await asyncio.to_thread(self._count_usage_locally, payload.get("messages", []), aggregated_content, model_id)
+                        usage_info = {
+                            "prompt_tokens": local_prompt_tokens,
+                            "completion_tokens": local_completion_tokens,
+                            "total_tokens": local_prompt_tokens + local_completion_tokens
                         }
-                        
-                        # 5. Log: Full Response
-                        full_resp_time = time.time()
-                        # Duration from First Token -> Full Return
-                        duration_since_ttft = (full_resp_time - ttft_time)*1000
-                        
-                        final_usage = final_response["usage"]
-                        p_tok = final_usage.get("prompt_tokens", 0)
-                        c_tok = final_usage.get("completion_tokens", 0)
-                        
-                        trace_logger.log(trace_id, "FULL_RESPONSE", full_resp_time, duration_since_ttft, "success", retry_count, details=f"完整响应接收完毕 | Tokens: {p_tok}+{c_tok}")
-                        if trace_callback:
-                            trace_callback("FULL_RESPONSE", full_resp_time, duration_since_ttft, "success", retry_count)
-                        
-                        return final_response
-                except Exception as e:
-                        # Propagate exception to context manager
-                        if not await ctx.__aexit__(type(e), e, e.__traceback__):
-                            raise
-                else:
-                        # Success exit
-                        await ctx.__aexit__(None, None, None)
-            
-            finally:
-                if temp_client:
-                    await temp_client.aclose()
+
+                    # 5. Log: Full Response (one clock read for created and the duration)
+                    full_resp_time = time.time()
+                    created_ts = int(full_resp_time)
+                    final_response = _chat_completion(f"chatcmpl-{created_ts}", created_ts, model_id, message, finish_reason or "stop", usage_info, local_prompt_tokens)
+                    
+                    # Duration from First Token -> Full Return
+                    duration_since_ttft = (full_resp_time - ttft_time)*1000
+                    
+                    final_usage = final_response["usage"]
+                    p_tok = final_usage.get("prompt_tokens", 0)
+                    c_tok = final_usage.get("completion_tokens", 0)
+                    
+                    trace_logger.log(trace_id, "FULL_RESPONSE", full_resp_time, duration_since_ttft, "success", retry_count, details=f"完整响应接收完毕 | Tokens: {p_tok}+{c_tok}")
+                    if trace_callback:
+                        trace_callback("FULL_RESPONSE", full_resp_time, duration_since_ttft, "success", retry_count)
+                    
+                    return final_response
+            except Exception as e:
+                    # Propagate exception to context manager
+                    if not await ctx.__aexit__(type(e), e, e.__traceback__):
+                        raise
+            else:
+                    # Success exit
+                    await ctx.__aexit__(None, None, None)
 
         except httpx.ReadTimeout:
-            raise Exception("Total Timeout (Read): Read timeout from upstream")
+            raise UpstreamError("Total Timeout (Read): Read timeout from upstream", "total")
         except httpx.ConnectTimeout:
-            raise Exception("Connect Timeout: Connect timeout to upstream")
+            raise UpstreamError("Connect Timeout: Connect timeout to upstream", "connect")
+
+    async def _aiter_sse_frames(self, response):
+        """Yield, per network chunk, the list of SSE `data: ` payloads (bytes or memoryview) it completed."""
+        parser = _SSEParser()
+        async for chunk in response.aiter_bytes():
+            frames = parser.feed(chunk)
+            if frames:
+                yield frames
+        # Final line without a trailing newline
+        frames = parser.flush()
+        if frames:
+            yield frames
+
+    async def _log_request(self, level, model, duration, status, prompt, request_obj: Dict[str, Any], response_obj: Union[Dict[str, Any], str], trace_data=None, stack_trace=None, retry_count=0, prompt_tokens=0, completion_tokens=0, token_source="upstream"):
+        """Queue a request log row; written in batches by _log_consumer.
+        
+        request_obj / response_obj are the live request dict and response dict (or error text);
+        nothing is serialized here, the writer only dumps the trimmed fields it keeps.
+        prompt is cut to the preview length before queueing so the queue never holds a full prompt."""
+        row = (level, model, duration, status, prompt[:self._PROMPT_PREVIEW_CHARS] if prompt else "", request_obj, response_obj, trace_data, stack_trace, retry_count, prompt_tokens, completion_tokens, token_source)
+        if self._log_task is None:
+            # Writer not running (e.g. startup() not called): write inline
+            await self._write_log_batch([row])
+            return
+        # Waits only when the queue is full (backpressure)
+        await self._log_queue.put(row)
+
+    async def _log_consumer(self):
+        """Drain the log queue, flushing every _LOG_BATCH_SIZE rows or _LOG_BATCH_WINDOW seconds. A None item stops it."""
+        queue = self._log_queue
+        loop = asyncio.get_running_loop()
+        running = True
+        while running:
+            row = await queue.get()
+            batch = []
+            if row is None:
+                running = False
+            else:
+                batch.append(row)
+                deadline = loop.time() + self._LOG_BATCH_WINDOW
+                while len(batch) < self._LOG_BATCH_SIZE:
+                    try:
+                        row = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        # Wait out the rest of the window for more rows
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            row = await asyncio.wait_for(queue.get(), timeout=remaining)
+                        except asyncio.TimeoutError:
+                            break
+                    if row is None:
+                        running = False
+                        break
+                    batch.append(row)
+            if batch:
+                await self._write_log_batch(batch)
+        # Flush anything queued behind the stop marker
+        remaining = []
+        while not queue.empty():
+            row = queue.get_nowait()
+            if row is not None:
+                remaining.append(row)
+        for i in range(0, len(remaining), self._LOG_BATCH_SIZE):
+            await self._write_log_batch(remaining[i:i + self._LOG_BATCH_SIZE])
+
+    async def _write_log_batch(self, rows: List[tuple]):
+        """Insert a batch of log rows with one executemany + commit, then refresh daily stats once per affected date."""
+        try:
+            entries = [self._build_log_entry(*row) for row in rows]
+            # begin() commits on exit (rolls back on error); Core insert with a list of
+            # parameter dicts -> single executemany, no ORM unit-of-work
+            async with AsyncSessionLocal() as session, session.begin():
+                await session.execute(insert(RequestLog), entries)
+            
+            from database import recalculate_daily_stats, utc_to_local, get_local_date_str
+            dates = {get_local_date_str(utc_to_local(e["timestamp"])) for e in entries}
+            for date_str in dates:
+                await recalculate_daily_stats(date_str)
+        except Exception as e:
+            logger.error(f"Failed to log request: {e}")
 
-    async def _log_request(self, level, model, duration, status, prompt, req_json, res_json, trace_data=None, stack_trace=None, retry_count=0, prompt_tokens=0, completion_tokens=0, token_source="upstream"):
-        # This function is now run in background
-        async with AsyncSessionLocal() as session:
+    def _build_log_entry(self, level, model, duration, status, prompt, request_obj, response_obj, trace_data=None, stack_trace=None, retry_count=0, prompt_tokens=0, completion_tokens=0, token_source="upstream") -> Dict[str, Any]:
+        # Optimize Logging: Extract only necessary info (inputs are already parsed, no JSON round-trip)
+        messages = request_obj.get("messages") or []
+        
+        # 2. Response: Only assistant content or tool calls
+        clean_res = "Empty"
+        response_tool_calls = None
+        if isinstance(response_obj, str):
+            clean_res = response_obj # Error text
+        else:
             try:
-                # Optimize Logging: Extract only necessary info
-                
-                # Determine Category
-                category = "chat"
-                try:
-                    # Check for tool calls in response
-                    if "tool_calls" in res_json:
-                         category = "tool"
+                choices = response_obj.get("choices")
+                if choices:
+                    message = choices[0].get("message", {})
+                    content = message.get("content")
+                    response_tool_calls = message.get("tool_calls")
                     
-                    # Check for tool calls in request (if any)
-                    # Simple string check for speed
-                    elif '"tool_calls":' in req_json or '"tools":' in req_json:
-                         category = "tool"
-                except:
-                    pass
-
-                # 1. Request: Only user messages
-                clean_req = "Check user_prompt_preview"
-                try:
-                    req_obj = json.loads(req_json)
-                    # Extract last user message or system instruction? User said "record user input".
-                    # Let's extract all messages but keep them minimal (content only)
-                    if "messages" in req_obj and req_obj["messages"]:
-                         # Only keep the last message to save space (Current Request)
-                         last_msg = req_obj["messages"][-1]
-                         clean_req = json.dumps([{
-                             "role": last_msg.get("role"), 
-                             "content": self._extract_text_from_content(last_msg.get("content"))
-                         }], ensure_ascii=False)
-                except:
-                    clean_req = req_json # Fallback
-
-                # 2. Response: Only assistant content or tool calls
-                clean_res = "Empty"
-                try:
-                    res_obj = json.loads(res_json)
-                    if "choices" in res_obj and len(res_obj["choices"]) > 0:
-                        message = res_obj["choices"][0].get("message", {})
-                        content = message.get("content")
-                        tool_calls = message.get("tool_calls")
+                    log_data = {}
+                    if content:
+                        log_data["content"] = content
+                    if response_tool_calls:
+                        log_data["tool_calls"] = response_tool_calls
                         
-                        log_data = {}
-                        if content:
-                            log_data["content"] = content
-                        if tool_calls:
-                            log_data["tool_calls"] = tool_calls
-                            
-                        clean_res = json.dumps(log_data, ensure_ascii=False)
-                    elif "error" in res_obj:
-                        clean_res = json.dumps(res_obj["error"], ensure_ascii=False)
-                except:
-                    clean_res = res_json # Fallback
-
-                log_entry = RequestLog(
-                    level=level,
-                    model=model,
-                    duration_ms=duration,
-                    status=status,
-                    user_prompt_preview=prompt[:200] if prompt else "",
-                    full_request=clean_req,
-                    full_response=clean_res,
-                    trace=json.dumps(trace_data) if trace_data else None,
-                    stack_trace=stack_trace,
-                    retry_count=retry_count,
-                    prompt_tokens=prompt_tokens,
-                    completion_tokens=completion_tokens,
-                    token_source=token_source,
-                    category=category
-                )
-                session.add(log_entry)
-                await session.commit()
-                
-                from database import update_daily_stats
-                await update_daily_stats(log_entry)
-            except Exception as e:
-                logger.error(f"Failed to log request: {e}")
+                    clean_res = _json_dumps(log_data)
+                elif "error" in response_obj:
+                    clean_res = _json_dumps(response_obj["error"])
+            except Exception:
+                clean_res = str(response_obj) # Fallback
+        
+        # Determine Category: O(1) checks first (response tool calls, request "tools" key);
+        # the per-message key scan only runs for requests that look like plain chat.
+        # Messages are validated dicts (ChatCompletionRequest), so no type checks are needed.
+        category = "tool" if (
+            response_tool_calls
+            or "tools" in request_obj
+            or any("tool_calls" in m for m in messages)
+        ) else "chat"
+
+        # 1. Request: Only the last message (Current Request), content flattened to text
+        clean_req = "Check user_prompt_preview"
+        if messages:
+            try:
+                last_msg = messages[-1]
+                clean_req = _json_dumps([{
+                    "role": last_msg.get("role"), 
+                    "content": self._extract_text_from_content(last_msg.get("content"))
+                }])
+            except Exception:
+                pass
+
+        # Column values for a Core insert; timestamp is set here so the batch writer knows each row's date
+        return {
+            "timestamp": datetime.utcnow(),
+            "level": level,
+            "model": model,
+            "duration_ms": duration,
+            "status": status,
+            "user_prompt_preview": prompt,
+            "full_request": clean_req,
+            "full_response": clean_res,
+            "trace": _json_dumps(trace_data) if trace_data else None,
+            "stack_trace": stack_trace,
+            "retry_count": retry_count,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "token_source": token_source,
+            "category": category
+        }
 
     async def test_model_connection(self, model_item: Any) -> Dict[str, Any]:
         """Test if a model is available and responsive."""
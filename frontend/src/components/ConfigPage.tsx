@@ -204,6 +204,16 @@ function GeneralSettings({ config, setConfig }: { config: AppConfig, setConfig:
                     />
                     <p className="text-xs text-muted-foreground">用于保护 OpenAI 接口访问。</p>
                 </div>
+                <div className="space-y-2">
+                    <div className="flex items-center gap-2">
+                        <Switch 
+                            checked={config.general.count_tokens_locally === true}
+                            onCheckedChange={(c) => setConfig({...config, general: {...config.general, count_tokens_locally: c}})}
+                        />
+                        <Label>本地计算 Token</Label>
+                    </div>
+                    <p className="text-xs text-muted-foreground">上游未返回 usage 时，在请求日志与统计中记录 tiktoken 本地估算的 Token 数；关闭时记录为"缺失"。返回给客户端的 usage 不受此开关影响。</p>
+                </div>
             </CardContent>
         </Card>
     )
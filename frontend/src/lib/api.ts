@@ -53,6 +53,7 @@ export interface ProviderConfig {
 export interface GeneralConfig {
   log_retention_days: number;
   gateway_api_key: string;
+  count_tokens_locally?: boolean;
 }
 
 export interface ModelEntry {
@@ -78,6 +79,8 @@ export interface RetrySettings {
   rounds: Record<string, number>;
   max_retries: Record<string, number>;
   conditions: RetryConfig;
+  status_policy?: Record<string, [number, number]>;
+  keyword_policy?: Record<string, [number, number]>;
 }
 
 export interface UpstreamConfig {